@@ -0,0 +1,166 @@
+import asyncio
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+from bot.db.sqlite_manager import SQLiteManager
+
+logger = logging.getLogger(__name__)
+
+FSM_STATE_TTL = 24 * 3600
+FSM_FLUSH_INTERVAL = 1.0
+FSM_CLEANUP_INTERVAL = 600.0
+
+_Record = Tuple[Optional[str], Dict[str, Any]]
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище aiogram поверх SQLiteManager.
+
+    Записи копятся в памяти и сбрасываются в БД пачкой раз в flush_interval, так что
+    set_state + update_data одного хендлера дают одну запись. Состояние, не менявшееся
+    дольше state_ttl, считается истёкшим и периодически удаляется. При нескольких процессах
+    бота на одной базе ставьте flush_interval=0 — тогда запись идёт сразу.
+    """
+
+    def __init__(
+        self,
+        db_manager: SQLiteManager,
+        key_builder: Optional[KeyBuilder] = None,
+        state_ttl: float = FSM_STATE_TTL,
+        flush_interval: float = FSM_FLUSH_INTERVAL,
+        cleanup_interval: float = FSM_CLEANUP_INTERVAL,
+    ):
+        self.db_manager = db_manager
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.state_ttl = state_ttl
+        self.flush_interval = flush_interval
+        self.cleanup_interval = cleanup_interval
+        self._pending: Dict[str, _Record] = {}
+        self._flushing: Dict[str, _Record] = {}
+        # Чтение и запись одного ключа под замком: иначе параллельные update_data
+        # начинают с одной и той же записи и затирают друг друга
+        self._key_locks: Dict[str, asyncio.Lock] = {}
+        self._key_lock_users: Dict[str, int] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._cleanup_task: Optional[asyncio.Task] = None
+
+    @asynccontextmanager
+    async def _locked(self, key: str) -> AsyncIterator[None]:
+        lock = self._key_locks.get(key)
+        if lock is None:
+            lock = self._key_locks[key] = asyncio.Lock()
+        self._key_lock_users[key] = self._key_lock_users.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._key_lock_users[key] -= 1
+            if not self._key_lock_users[key]:
+                del self._key_lock_users[key]
+                del self._key_locks[key]
+
+    async def _load(self, key: str) -> _Record:
+        if key in self._pending:
+            return self._pending[key]
+        if key in self._flushing:
+            return self._flushing[key]
+        row = await self.db_manager.get_fsm_record(key, time.time() - self.state_ttl)
+        if row is None:
+            return None, {}
+        state, data = row
+        return state, json.loads(data) if data else {}
+
+    async def _store(self, key: str, record: _Record):
+        self._pending[key] = record
+        self._ensure_cleanup_task()
+        if self.flush_interval <= 0:
+            await self.flush()
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        # Цикл подхватывает записи, пришедшие во время сохранения предыдущей пачки
+        while self._pending:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Не удалось сохранить FSM-состояния: {e}", exc_info=True)
+
+    async def flush(self):
+        """Сбрасывает накопленные изменения в БД одной транзакцией."""
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        self._flushing.update(batch)
+        now = time.time()
+        records = [
+            (key, state, json.dumps(data, ensure_ascii=False) if (state or data) else None, now)
+            for key, (state, data) in batch.items()
+        ]
+        try:
+            await self.db_manager.save_fsm_records(records)
+        except BaseException:
+            # Не теряем изменения: более свежие записи из _pending приоритетнее
+            for key, record in batch.items():
+                self._pending.setdefault(key, record)
+            raise
+        finally:
+            for key, record in batch.items():
+                if self._flushing.get(key) is record:
+                    del self._flushing[key]
+
+    def _ensure_cleanup_task(self):
+        if self._cleanup_task is None or self._cleanup_task.done():
+            self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+    async def _cleanup_loop(self):
+        while True:
+            await asyncio.sleep(self.cleanup_interval)
+            try:
+                removed = await self.db_manager.delete_expired_fsm_records(time.time() - self.state_ttl)
+                if removed:
+                    logger.info(f"Удалено истёкших FSM-состояний: {removed}")
+            except Exception as e:
+                logger.warning("Очистка FSM-состояний не удалась: %s", e)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = self.key_builder.build(key)
+        async with self._locked(k):
+            _, data = await self._load(k)
+            await self._store(k, (state.state if isinstance(state, State) else state, data))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        k = self.key_builder.build(key)
+        async with self._locked(k):
+            state, _ = await self._load(k)
+            await self._store(k, (state, data.copy()))
+
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        k = self.key_builder.build(key)
+        async with self._locked(k):
+            state, current = await self._load(k)
+            current = {**current, **data}
+            await self._store(k, (state, current))
+            return current.copy()
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self.key_builder.build(key))
+        return data.copy()
+
+    async def close(self) -> None:
+        for task in (self._flush_task, self._cleanup_task):
+            if task and not task.done():
+                task.cancel()
+        await self.flush()
@@ -0,0 +1,156 @@
+import logging
+import time
+from typing import Awaitable, Callable, List, NamedTuple
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[aiosqlite.Connection], Awaitable[None]]
+
+
+async def _table_columns(db: aiosqlite.Connection, table: str) -> set:
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        return {row[1] for row in await cursor.fetchall()}
+
+
+async def _add_column_if_missing(db: aiosqlite.Connection, table: str, column: str, ddl: str):
+    """ALTER TABLE ADD COLUMN только для отсутствующей колонки (базы, созданные до миграций)."""
+    if column not in await _table_columns(db, table):
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+
+async def _m001_initial_schema(db: aiosqlite.Connection):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            llm_provider TEXT DEFAULT 'trinity',
+            meta_prompt TEXT,
+            context_prompt TEXT,
+            ab_testing_enabled INTEGER DEFAULT 0,
+            mode TEXT DEFAULT 'simple',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS agent_conversation (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+async def _m002_user_preferences(db: aiosqlite.Connection):
+    await _add_column_if_missing(db, "users", "mode", "TEXT DEFAULT 'simple'")
+    for col in ("preference_style", "preference_goal", "preference_format"):
+        await _add_column_if_missing(db, "users", col, "TEXT")
+    await _add_column_if_missing(db, "users", "temperature", "REAL DEFAULT 0.4")
+
+
+async def _m003_agent_conversation_index(db: aiosqlite.Connection):
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_agent_conversation_user_id
+        ON agent_conversation (user_id, id)
+    """)
+
+
+async def _m004_fsm_state(db: aiosqlite.Connection):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_state (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_fsm_state_updated_at ON fsm_state (updated_at)")
+
+
+async def _m005_llm_cache(db: aiosqlite.Connection):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_expires_at ON llm_cache (expires_at)")
+
+
+async def _m006_agent_summary(db: aiosqlite.Connection):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS agent_summary (
+            user_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+# Новые изменения схемы — только добавлением миграции в конец списка со следующим номером
+MIGRATIONS: List[Migration] = [
+    Migration(1, "initial schema", _m001_initial_schema),
+    Migration(2, "user mode, preferences and temperature", _m002_user_preferences),
+    Migration(3, "agent_conversation (user_id, id) index", _m003_agent_conversation_index),
+    Migration(4, "fsm_state table", _m004_fsm_state),
+    Migration(5, "llm_cache table", _m005_llm_cache),
+    Migration(6, "agent_summary table", _m006_agent_summary),
+]
+
+
+async def _current_version(db: aiosqlite.Connection) -> int:
+    async with db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version") as cursor:
+        return (await cursor.fetchone())[0]
+
+
+async def apply_migrations(db: aiosqlite.Connection) -> List[Migration]:
+    """Применяет недостающие миграции одной транзакцией и возвращает список применённых."""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            duration_ms REAL
+        )
+    """)
+    await db.commit()
+    if await _current_version(db) >= MIGRATIONS[-1].version:
+        return []
+
+    # IMMEDIATE сразу берёт блокировку записи: параллельно стартующий экземпляр дождётся её
+    # и перечитает версию, а не применит те же миграции повторно.
+    await db.execute("BEGIN IMMEDIATE")
+    applied: List[Migration] = []
+    try:
+        current = await _current_version(db)
+        started = time.perf_counter()
+        for migration in MIGRATIONS:
+            if migration.version <= current:
+                continue
+            step_started = time.perf_counter()
+            await migration.apply(db)
+            duration_ms = (time.perf_counter() - step_started) * 1000
+            await db.execute(
+                "INSERT INTO schema_version (version, name, duration_ms) VALUES (?, ?, ?)",
+                (migration.version, migration.name, duration_ms)
+            )
+            applied.append(migration)
+            logger.info(f"Миграция {migration.version} ({migration.name}): {duration_ms:.1f} мс")
+        await db.commit()
+    except BaseException:
+        await db.rollback()
+        raise
+    if applied:
+        total_ms = (time.perf_counter() - started) * 1000
+        logger.info(f"Схема обновлена до версии {applied[-1].version} за {total_ms:.1f} мс")
+    return applied
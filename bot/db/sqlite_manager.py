@@ -1,73 +1,153 @@
+import asyncio
 import aiosqlite
-from typing import Optional, Dict, Any, List
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, List, AsyncIterator, Tuple
 import logging
 import sqlite3
 
+from bot.db.cache import TTLCache
+from bot.db.migrations import apply_migrations
+
 logger = logging.getLogger(__name__)
 
-AGENT_HISTORY_LIMIT = 16
+# Сколько сообщений агента хранится на пользователя; в запрос к модели из них попадает
+# столько, сколько влезает в бюджет токенов (LLMService.token_budget). Лимит поднят с 16,
+# когда длину запроса стал ограничивать бюджет, а не число сообщений: короткие диалоги
+# сохраняют больше контекста, длинные всё равно обрезаются бюджетом. Цена — в 2.5 раза
+# больше строк agent_conversation на пользователя (сворачивание AGENT_SUMMARY их сокращает).
+AGENT_HISTORY_LIMIT = 40
+DB_POOL_SIZE = 4
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300.0
+# INSERT ... RETURNING появился в SQLite 3.35
+UPSERT_RETURNING_SUPPORTED = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Настройки, применяемые к каждому соединению пула. WAL позволяет читать параллельно с записью,
+# synchronous=NORMAL в WAL-режиме безопасен и не делает fsync на каждый коммит.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+)
 
 
 class SQLiteManager:
-    def __init__(self, db_path: str = "bot.db"):
+    def __init__(
+        self,
+        db_path: str = "bot.db",
+        pool_size: int = DB_POOL_SIZE,
+        user_cache_size: int = USER_CACHE_SIZE,
+        user_cache_ttl: float = USER_CACHE_TTL,
+    ):
         self.db_path = db_path
+        self.pool_size = max(1, pool_size)
+        self._pool: Optional[asyncio.Queue] = None
+        self._connections: List[aiosqlite.Connection] = []
+        self._pool_lock = asyncio.Lock()
+        self._closed = False
+        # Кэш строк users: настройки меняются редко, а читаются на каждый клик по меню
+        self._user_cache = TTLCache(max_size=user_cache_size, ttl=user_cache_ttl)
+        # Счётчик записей в users: чтение, пересёкшееся с записью, не кладёт в кэш устаревшую строку
+        self._user_write_seq = 0
 
-    async def init_db(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    llm_provider TEXT DEFAULT 'trinity',
-                    meta_prompt TEXT,
-                    context_prompt TEXT,
-                    ab_testing_enabled INTEGER DEFAULT 0,
-                    mode TEXT DEFAULT 'simple',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
+    async def _open_connection(self) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(self.db_path)
+        db.row_factory = aiosqlite.Row
+        for pragma in SQLITE_PRAGMAS:
+            await db.execute(pragma)
+        return db
+
+    async def open_pool(self):
+        """Открывает пул долгоживущих соединений (однократно)."""
+        async with self._pool_lock:
+            if self._pool is not None:
+                return
+            pool: asyncio.Queue = asyncio.Queue()
             try:
-                await db.execute("ALTER TABLE users ADD COLUMN mode TEXT DEFAULT 'simple'")
-                await db.commit()
-            except aiosqlite.OperationalError:
+                for _ in range(self.pool_size):
+                    db = await self._open_connection()
+                    self._connections.append(db)
+                    pool.put_nowait(db)
+            except Exception:
+                for db in self._connections:
+                    await db.close()
+                self._connections = []
+                raise
+            self._pool = pool
+            logger.info(f"Открыт пул SQLite: {self.pool_size} соединений")
+
+    @asynccontextmanager
+    async def _connection(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Берёт соединение из пула; незавершённая при ошибке транзакция откатывается."""
+        if self._pool is None:
+            if self._closed:
+                # Опоздавший обработчик после остановки не должен молча открывать пул заново
+                raise RuntimeError("Пул SQLite уже закрыт")
+            await self.open_pool()
+        pool = self._pool
+        db = await pool.get()
+        try:
+            yield db
+        except BaseException:
+            if db.in_transaction:
                 await db.rollback()
-            for col in ("preference_style", "preference_goal", "preference_format"):
+            raise
+        finally:
+            pool.put_nowait(db)
+
+    async def close(self):
+        """Закрывает все соединения пула; после этого запросы к базе завершаются ошибкой."""
+        async with self._pool_lock:
+            self._closed = True
+            if self._pool is None:
+                return
+            for db in self._connections:
                 try:
-                    await db.execute(f"ALTER TABLE users ADD COLUMN {col} TEXT")
-                    await db.commit()
-                except aiosqlite.OperationalError:
-                    await db.rollback()
-            try:
-                await db.execute("ALTER TABLE users ADD COLUMN temperature REAL DEFAULT 0.4")
-                await db.commit()
-            except aiosqlite.OperationalError:
-                await db.rollback()
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS agent_conversation (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    role TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            await db.commit()
-            logger.info("База данных инициализирована")
+                    await db.close()
+                except Exception as e:
+                    logger.warning("Ошибка при закрытии соединения SQLite: %s", e)
+            self._connections = []
+            self._pool = None
+            logger.info("Пул SQLite закрыт")
+
+    async def init_db(self):
+        await self.open_pool()
+        async with self._connection() as db:
+            await apply_migrations(db)
+        logger.info("База данных инициализирована")
+
+    @staticmethod
+    def _row_to_user(row) -> Dict[str, Any]:
+        d = dict(row)
+        if "mode" not in d:
+            d["mode"] = "simple"
+        if "temperature" not in d or d["temperature"] is None:
+            d["temperature"] = 0.4
+        return d
+
+    def get_cache_stats(self) -> Dict[str, Any]:
+        """Счётчики попаданий/промахов кэша пользователей."""
+        return self._user_cache.stats()
+
+    def _cache_user(self, user: Dict[str, Any], read_seq: Optional[int] = None) -> Dict[str, Any]:
+        if read_seq is None or read_seq == self._user_write_seq:
+            self._user_cache.set(user["user_id"], user)
+        return dict(user)
 
     async def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        cached = self._user_cache.get(user_id)
+        if cached is not None:
+            return dict(cached)
+        read_seq = self._user_write_seq
+        async with self._connection() as db:
             async with db.execute(
                 "SELECT * FROM users WHERE user_id = ?", (user_id,)
             ) as cursor:
                 row = await cursor.fetchone()
                 if row:
-                    d = dict(row)
-                    if "mode" not in d:
-                        d["mode"] = "simple"
-                    if "temperature" not in d or d["temperature"] is None:
-                        d["temperature"] = 0.4
-                    return d
+                    return self._cache_user(self._row_to_user(row), read_seq)
                 return None
 
     async def create_user(
@@ -77,22 +157,28 @@ class SQLiteManager:
         context_prompt: str,
         llm_provider: str = "trinity",
     ):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connection() as db:
             await db.execute("""
                 INSERT INTO users (user_id, llm_provider, meta_prompt, context_prompt)
                 VALUES (?, ?, ?, ?)
             """, (user_id, llm_provider, meta_prompt, context_prompt))
             await db.commit()
-            logger.info(f"Создан пользователь {user_id}")
+        self._user_write_seq += 1
+        self._user_cache.pop(user_id)
+        logger.info(f"Создан пользователь {user_id}")
 
     async def update_user_setting(self, user_id: int, field: str, value: Any):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connection() as db:
             await db.execute(
                 f"UPDATE users SET {field} = ?, updated_at = CURRENT_TIMESTAMP WHERE user_id = ?",
                 (value, user_id)
             )
             await db.commit()
-            logger.info(f"Обновлена настройка {field} для пользователя {user_id}")
+        self._user_write_seq += 1
+        cached = self._user_cache.pop(user_id)
+        if cached is not None:
+            self._cache_user(self._row_to_user({**cached, field: value}))
+        logger.info(f"Обновлена настройка {field} для пользователя {user_id}")
 
     async def get_or_create_user(
         self,
@@ -100,6 +186,45 @@ class SQLiteManager:
         default_meta_prompt: str,
         default_context_prompt: str
     ) -> Dict[str, Any]:
+        """Возвращает пользователя, создавая его при первом обращении; для существующего — только чтение."""
+        cached = self._user_cache.get(user_id)
+        if cached is not None:
+            return dict(cached)
+        if not UPSERT_RETURNING_SUPPORTED:
+            return await self._get_or_create_user_legacy(
+                user_id, default_meta_prompt, default_context_prompt
+            )
+        user = await self.get_user(user_id)
+        if user is not None:
+            return user
+        read_seq = self._user_write_seq
+        # Пишем только для нового пользователя; при гонке двух первых запросов DO NOTHING
+        # не вернёт строку, и её дочитывает обычный SELECT
+        async with self._connection() as db:
+            async with db.execute(
+                """INSERT INTO users (user_id, meta_prompt, context_prompt)
+                   VALUES (?, ?, ?)
+                   ON CONFLICT(user_id) DO NOTHING
+                   RETURNING *""",
+                (user_id, default_meta_prompt, default_context_prompt)
+            ) as cursor:
+                row = await cursor.fetchone()
+            await db.commit()
+        if row is None:
+            user = await self.get_user(user_id)
+            if user is None:
+                raise RuntimeError("get_or_create_user: user still None after insert")
+            return user
+        logger.info(f"Создан пользователь {user_id}")
+        return self._cache_user(self._row_to_user(row), read_seq)
+
+    async def _get_or_create_user_legacy(
+        self,
+        user_id: int,
+        default_meta_prompt: str,
+        default_context_prompt: str
+    ) -> Dict[str, Any]:
+        """SELECT + INSERT для SQLite < 3.35 (нет RETURNING)."""
         user = await self.get_user(user_id)
         if user is None:
             try:
@@ -113,44 +238,155 @@ class SQLiteManager:
             user = await self.get_user(user_id)
         if user is None:
             raise RuntimeError("get_or_create_user: user still None after create")
-        if "mode" not in user:
-            user["mode"] = "simple"
         return user
 
-    async def add_agent_message(self, user_id: int, role: str, content: str):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
+    async def add_agent_messages(self, user_id: int, messages: List[Tuple[str, str]]):
+        """Добавляет сообщения (role, content) одной транзакцией и обрезает историю до AGENT_HISTORY_LIMIT."""
+        if not messages:
+            return
+        async with self._connection() as db:
+            await db.executemany(
                 "INSERT INTO agent_conversation (user_id, role, content) VALUES (?, ?, ?)",
-                (user_id, role, content)
+                [(user_id, role, content) for role, content in messages]
+            )
+            # Оставляем только последние N сообщений: граница ищется по индексу (user_id, id), без COUNT(*)
+            await db.execute(
+                """DELETE FROM agent_conversation WHERE user_id = ? AND id <= (
+                    SELECT id FROM agent_conversation WHERE user_id = ?
+                    ORDER BY id DESC LIMIT 1 OFFSET ?
+                )""",
+                (user_id, user_id, AGENT_HISTORY_LIMIT)
             )
             await db.commit()
-            async with db.execute(
-                "SELECT COUNT(*) FROM agent_conversation WHERE user_id = ?",
-                (user_id,)
-            ) as cur:
-                n = (await cur.fetchone())[0]
-            if n > AGENT_HISTORY_LIMIT:
-                await db.execute(
-                    """DELETE FROM agent_conversation WHERE user_id = ? AND id IN (
-                        SELECT id FROM agent_conversation WHERE user_id = ? ORDER BY id ASC LIMIT ?
-                    )""",
-                    (user_id, user_id, n - AGENT_HISTORY_LIMIT)
-                )
-                await db.commit()
 
     async def get_agent_history(self, user_id: int, limit: int = AGENT_HISTORY_LIMIT) -> List[Dict[str, str]]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        """
+        Последние limit сообщений по порядку (под бюджет токенов их обрезает chat_with_history).
+
+        Если раньше часть диалога была свёрнута в краткое содержание, оно идёт первым сообщением
+        с ролью system.
+        """
+        async with self._connection() as db:
             async with db.execute(
                 """SELECT role, content FROM agent_conversation
                    WHERE user_id = ? ORDER BY id DESC LIMIT ?""",
                 (user_id, limit)
             ) as cursor:
                 rows = await cursor.fetchall()
+            async with db.execute("SELECT summary FROM agent_summary WHERE user_id = ?", (user_id,)) as cursor:
+                summary_row = await cursor.fetchone()
         out = [{"role": r["role"], "content": r["content"]} for r in reversed(rows)]
+        if summary_row:
+            out.insert(0, {"role": "system", "content": summary_row["summary"]})
         return out
 
+    async def get_agent_history_rows(self, user_id: int) -> List[Tuple[int, str, str]]:
+        """Вся сохранённая история (id, role, content) по порядку — для сворачивания в краткое содержание."""
+        async with self._connection() as db:
+            async with db.execute(
+                "SELECT id, role, content FROM agent_conversation WHERE user_id = ? ORDER BY id",
+                (user_id,)
+            ) as cursor:
+                rows = await cursor.fetchall()
+        return [(r["id"], r["role"], r["content"]) for r in rows]
+
+    async def get_agent_summary(self, user_id: int) -> Optional[str]:
+        async with self._connection() as db:
+            async with db.execute("SELECT summary FROM agent_summary WHERE user_id = ?", (user_id,)) as cursor:
+                row = await cursor.fetchone()
+        return row["summary"] if row else None
+
+    async def save_agent_summary(self, user_id: int, summary: str, up_to_id: int) -> bool:
+        """
+        Заменяет сообщения с id <= up_to_id кратким содержанием одной транзакцией.
+
+        Если этих сообщений уже нет (историю очистили, пока строилось содержание), ничего не
+        сохраняет и возвращает False.
+        """
+        async with self._connection() as db:
+            cursor = await db.execute(
+                "DELETE FROM agent_conversation WHERE user_id = ? AND id <= ?", (user_id, up_to_id)
+            )
+            if cursor.rowcount == 0:
+                await db.rollback()
+                return False
+            await db.execute(
+                """INSERT INTO agent_summary (user_id, summary, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+                   ON CONFLICT(user_id) DO UPDATE SET summary = excluded.summary, updated_at = excluded.updated_at""",
+                (user_id, summary)
+            )
+            await db.commit()
+        return True
+
     async def clear_agent_history(self, user_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connection() as db:
             await db.execute("DELETE FROM agent_conversation WHERE user_id = ?", (user_id,))
-            await db.commit()
\ No newline at end of file
+            await db.execute("DELETE FROM agent_summary WHERE user_id = ?", (user_id,))
+            await db.commit()
+
+    async def get_fsm_record(self, key: str, min_updated_at: float) -> Optional[Tuple[Optional[str], str]]:
+        """(state, data_json) записи FSM, если она обновлялась не раньше min_updated_at."""
+        async with self._connection() as db:
+            async with db.execute(
+                "SELECT state, data FROM fsm_state WHERE key = ? AND updated_at >= ?",
+                (key, min_updated_at)
+            ) as cursor:
+                row = await cursor.fetchone()
+        return (row["state"], row["data"]) if row else None
+
+    async def save_fsm_records(self, records: List[Tuple[str, Optional[str], Optional[str], float]]):
+        """Пакетно сохраняет записи FSM (key, state, data_json, updated_at); data_json=None — удалить запись."""
+        if not records:
+            return
+        upserts = [r for r in records if r[2] is not None]
+        deletes = [(r[0],) for r in records if r[2] is None]
+        async with self._connection() as db:
+            if upserts:
+                await db.executemany(
+                    """INSERT INTO fsm_state (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                       ON CONFLICT(key) DO UPDATE SET
+                           state = excluded.state, data = excluded.data, updated_at = excluded.updated_at""",
+                    upserts
+                )
+            if deletes:
+                await db.executemany("DELETE FROM fsm_state WHERE key = ?", deletes)
+            await db.commit()
+
+    async def delete_expired_fsm_records(self, before: float) -> int:
+        async with self._connection() as db:
+            cursor = await db.execute("DELETE FROM fsm_state WHERE updated_at < ?", (before,))
+            await db.commit()
+            return cursor.rowcount
+
+    async def get_llm_cache_entry(self, key: str, now: float) -> Optional[str]:
+        async with self._connection() as db:
+            async with db.execute(
+                "SELECT response FROM llm_cache WHERE key = ? AND expires_at > ?", (key, now)
+            ) as cursor:
+                row = await cursor.fetchone()
+        return row["response"] if row else None
+
+    async def save_llm_cache_entry(
+        self, key: str, model: str, response: str, created_at: float, expires_at: float, max_entries: int
+    ):
+        """Сохраняет ответ и оставляет в таблице не больше max_entries самых свежих записей."""
+        async with self._connection() as db:
+            # REPLACE выдаёт строке новый rowid, поэтому порядок rowid — порядок записи
+            await db.execute(
+                """INSERT OR REPLACE INTO llm_cache (key, model, response, created_at, expires_at)
+                   VALUES (?, ?, ?, ?, ?)""",
+                (key, model, response, created_at, expires_at)
+            )
+            await db.execute(
+                """DELETE FROM llm_cache WHERE rowid <= (
+                       SELECT rowid FROM llm_cache ORDER BY rowid DESC LIMIT 1 OFFSET ?
+                   )""",
+                (max(1, max_entries),)
+            )
+            await db.commit()
+
+    async def delete_expired_llm_cache_entries(self, now: float) -> int:
+        async with self._connection() as db:
+            cursor = await db.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (now,))
+            await db.commit()
+            return cursor.rowcount
@@ -5,6 +5,8 @@ from aiogram.fsm.state import State, StatesGroup
 import logging
 
 from bot.db.sqlite_manager import SQLiteManager
+from bot.services.llm_client import is_llm_provider_error
+from bot.services.user_tasks import SupersededError
 from bot.handlers.keyboards import (
     get_settings_keyboard,
     get_customization_keyboard,
@@ -35,19 +37,18 @@ from bot.handlers.commands import (
     _reply_has_prompt_block,
     _parse_agent_questions,
     _get_previous_agent_prompt,
-    _agent_metrics_line,
-    _rouge_line,
-    _rouge_scores,
-    _why_better_line,
+    _compact_prompt_blocks,
+    _reply_metrics_lines,
     _html_escape,
     _send_long_message,
     _send_agent_reply_safe,
-    _is_llm_provider_error,
     QUESTIONS_OPEN,
     _format_preferences_for_prompt,
+    _skip_questions_request,
 )
 
 PROVIDER_NAMES = {
+    "auto": "Авто (самая быстрая)",
     "deepseek": "DeepSeek",
     "openai": "ChatGPT",
     "gemini": "Gemini",
@@ -461,20 +462,31 @@ async def callback_cancel_edit(callback: CallbackQuery, state: FSMContext, db_ma
     await callback.answer("Редактирование отменено")
 
 
+def _load_agent_answers(data: dict) -> dict:
+    """Ответы на вопросы агента из FSM; ключи-индексы приводятся к int (JSON-хранилище отдаёт строки)."""
+    raw = data.get("agent_answers") or {}
+    return {int(k): v for k, v in raw.items()}
+
+
 @router.callback_query(AgentStates.answering_questions, F.data.startswith("aq_"))
 async def callback_agent_question_answer(
     callback: CallbackQuery,
     state: FSMContext,
     db_manager: SQLiteManager,
     llm_service,
+    user_tasks,
+    history_summarizer=None,
+    speculative_replies=None,
 ):
     raw = callback.data
     if raw == "aq_done":
         await callback.answer("Формирую итоговый промпт…")
+        if speculative_replies:
+            speculative_replies.cancel(callback.from_user.id)
         data = await state.get_data()
         original_request = data.get("agent_original_request") or ""
         questions = data.get("agent_questions") or []
-        answers = data.get("agent_answers") or {}
+        answers = _load_agent_answers(data)
         provider = data.get("agent_provider") or "gemini"
         prefs = data.get("agent_prefs") or ""
         lines = []
@@ -495,7 +507,6 @@ async def callback_agent_question_answer(
                 opt_text = ", ".join(chosen)
             lines.append(f"{q_idx + 1}. {q.get('question', '')}: {opt_text}")
         answers_text = "\n".join(lines)
-        system_prompt = (prefs + "\n\n" + AGENT_SYSTEM_PROMPT_BASE) if prefs else AGENT_SYSTEM_PROMPT_BASE
         user_content = (
             f"Исходный запрос пользователя:\n{original_request}\n\n"
             f"Ответы на уточняющие вопросы:\n{answers_text}\n\n"
@@ -510,17 +521,28 @@ async def callback_agent_question_answer(
             user_id, DEFAULT_META_PROMPT, DEFAULT_CONTEXT
         )
         temperature = float(user.get("temperature", 0.4))
+        # Вопросы могут ещё дописываться: запрос, который их пишет, больше не нужен
+        turn = user_tasks.begin(user_id, supersede=True)
         try:
-            reply = await llm_service.chat_with_history(
-                user_content=user_content,
-                history=[],
-                system_prompt=system_prompt,
-                provider=provider,
-                temperature=temperature,
+            reply = await user_tasks.run(
+                user_id,
+                turn,
+                lambda: llm_service.chat_with_history(
+                    user_content=user_content,
+                    history=[],
+                    system_prompt=AGENT_SYSTEM_PROMPT_BASE,
+                    user_context=prefs,
+                    provider=provider,
+                    temperature=temperature,
+                ),
             )
             user_msg_for_history = original_request + "\n\nОтветы на вопросы:\n" + answers_text
-            await db_manager.add_agent_message(user_id, "user", user_msg_for_history)
-            await db_manager.add_agent_message(user_id, "assistant", reply)
+            async with user_tasks.history_lock(user_id):
+                await db_manager.add_agent_messages(
+                    user_id, [("user", user_msg_for_history), ("assistant", reply)]
+                )
+            if history_summarizer:
+                history_summarizer.schedule(user_id)
             if not _reply_has_prompt_block(reply):
                 await callback.message.answer(
                     "⚠️ Модель вернула уточнения вместо готового промпта. "
@@ -529,19 +551,7 @@ async def callback_agent_question_answer(
                 )
                 return
             intro, prompt_block, outro = _parse_agent_reply(reply)
-            extra = []
-            if prompt_block.strip():
-                metrics_line = _agent_metrics_line(original_request, prompt_block)
-                if metrics_line:
-                    extra.append(metrics_line)
-                rouge_orig = _rouge_line("Похожесть на исходный запрос", original_request, prompt_block)
-                if rouge_orig:
-                    extra.append(rouge_orig)
-                scores = _rouge_scores(original_request, prompt_block)
-                rouge_r1 = scores[0] if scores else None
-                why_line = _why_better_line(original_request, prompt_block, rouge_r1)
-                if why_line:
-                    extra.append(why_line)
+            extra = await _reply_metrics_lines("Похожесть на исходный запрос", original_request, prompt_block)
             await _send_agent_reply_safe(
                 callback.message,
                 intro=intro or "",
@@ -550,9 +560,11 @@ async def callback_agent_question_answer(
                 extra_lines=extra,
                 reply_markup=get_agent_result_keyboard(),
             )
+        except SupersededError:
+            pass
         except Exception as e:
             logger.exception("Ошибка при формировании промпта из ответов: %s", e)
-            if _is_llm_provider_error(e):
+            if is_llm_provider_error(e):
                 pname = PROVIDER_NAMES.get(provider, provider)
                 text = (
                     f"❌ Сейчас не удаётся обратиться к модели <b>{pname}</b>.\n\n"
@@ -575,14 +587,6 @@ async def callback_agent_question_answer(
         original_request = data.get("agent_original_request") or ""
         provider = data.get("agent_provider") or "gemini"
         prefs = data.get("agent_prefs") or ""
-        system_prompt = (prefs + "\n\n" + AGENT_SYSTEM_PROMPT_BASE) if prefs else AGENT_SYSTEM_PROMPT_BASE
-        user_content = (
-            "Пользователь хочет получить итоговый промпт СРАЗУ, без дополнительных уточняющих вопросов.\n"
-            "Сформируй промпт только на основе запроса ниже, не добавляя новых деталей.\n\n"
-            f"{original_request}\n\n"
-            "Ответ должен быть СТРОГО в виде одного блока [PROMPT]...[/PROMPT]. Не возвращай [QUESTIONS].\n"
-            "ОБЯЗАТЕЛЬНО верни результат ТОЛЬКО в формате [PROMPT] и [/PROMPT] (каждый тег на отдельной строке)."
-        )
         await callback.message.edit_text("🔄 Формирую промпт без дополнительных вопросов...")
         await state.clear()
         user_id = callback.from_user.id
@@ -590,16 +594,25 @@ async def callback_agent_question_answer(
             user_id, DEFAULT_META_PROMPT, DEFAULT_CONTEXT
         )
         temperature = float(user.get("temperature", 0.4))
+        request = _skip_questions_request(original_request, provider, prefs, temperature)
+
+        async def _skip_reply():
+            if speculative_replies:
+                # Ответ мог быть заготовлен, пока пользователь читал вопросы
+                reply = await speculative_replies.take(user_id, **request)
+                if reply is not None:
+                    return reply
+            return await llm_service.chat_with_history(**request)
+
+        turn = user_tasks.begin(user_id, supersede=True)
         try:
-            reply = await llm_service.chat_with_history(
-                user_content=user_content,
-                history=[],
-                system_prompt=system_prompt,
-                provider=provider,
-                temperature=temperature,
-            )
-            await db_manager.add_agent_message(user_id, "user", original_request)
-            await db_manager.add_agent_message(user_id, "assistant", reply)
+            reply = await user_tasks.run(user_id, turn, _skip_reply)
+            async with user_tasks.history_lock(user_id):
+                await db_manager.add_agent_messages(
+                    user_id, [("user", original_request), ("assistant", reply)]
+                )
+            if history_summarizer:
+                history_summarizer.schedule(user_id)
             if not _reply_has_prompt_block(reply):
                 await callback.message.answer(
                     "⚠️ Модель вернула уточнения вместо готового промпта. "
@@ -608,19 +621,7 @@ async def callback_agent_question_answer(
                 )
                 return
             intro, prompt_block, outro = _parse_agent_reply(reply)
-            extra = []
-            if prompt_block.strip():
-                metrics_line = _agent_metrics_line(original_request, prompt_block)
-                if metrics_line:
-                    extra.append(metrics_line)
-                rouge_orig = _rouge_line("Похожесть на исходный запрос", original_request, prompt_block)
-                if rouge_orig:
-                    extra.append(rouge_orig)
-                scores = _rouge_scores(original_request, prompt_block)
-                rouge_r1 = scores[0] if scores else None
-                why_line = _why_better_line(original_request, prompt_block, rouge_r1)
-                if why_line:
-                    extra.append(why_line)
+            extra = await _reply_metrics_lines("Похожесть на исходный запрос", original_request, prompt_block)
             await _send_agent_reply_safe(
                 callback.message,
                 intro=intro or "",
@@ -629,9 +630,11 @@ async def callback_agent_question_answer(
                 extra_lines=extra,
                 reply_markup=get_agent_result_keyboard(),
             )
+        except SupersededError:
+            pass
         except Exception as e:
             logger.exception("Ошибка при формировании промпта без вопросов: %s", e)
-            if _is_llm_provider_error(e):
+            if is_llm_provider_error(e):
                 pname = PROVIDER_NAMES.get(provider, provider)
                 text = (
                     f"❌ Сейчас не удаётся обратиться к модели <b>{pname}</b>.\n\n"
@@ -660,7 +663,7 @@ async def callback_agent_question_answer(
         return
     data = await state.get_data()
     questions = data.get("agent_questions") or []
-    answers = data.get("agent_answers") or {}
+    answers = _load_agent_answers(data)
     if q_idx < 0 or q_idx >= len(questions):
         await callback.answer()
         return
@@ -693,9 +696,15 @@ async def callback_agent_question_answer(
 
 
 @router.callback_query(F.data == "agent_accept_prompt")
-async def callback_agent_accept_prompt(callback: CallbackQuery, db_manager: SQLiteManager):
+async def callback_agent_accept_prompt(
+    callback: CallbackQuery, db_manager: SQLiteManager, user_tasks, speculative_replies=None
+):
     user_id = callback.from_user.id
-    await db_manager.clear_agent_history(user_id)
+    if speculative_replies:
+        speculative_replies.cancel(user_id)
+    user_tasks.cancel(user_id)
+    async with user_tasks.history_lock(user_id):
+        await db_manager.clear_agent_history(user_id)
     try:
         await callback.message.edit_reply_markup(reply_markup=get_result_nav_keyboard())
     except Exception:
@@ -709,6 +718,9 @@ async def callback_agent_continue(
     db_manager: SQLiteManager,
     llm_service,
     state: FSMContext,
+    user_tasks,
+    history_summarizer=None,
+    speculative_replies=None,
 ):
     """При нажатии 'Уточнить ещё' агент анализирует текущий промпт и задаёт уточняющие вопросы."""
     user_id = callback.from_user.id
@@ -745,7 +757,6 @@ async def callback_agent_continue(
             )
             return
         prefs_text = _format_preferences_for_prompt(user)
-        system_prompt = (prefs_text + "\n\n" + AGENT_SYSTEM_PROMPT_BASE) if prefs_text else AGENT_SYSTEM_PROMPT_BASE
         user_content = (
             "Пользователь хочет получить уточняющие вопросы по этому запросу. "
             "Задай уточняющие вопросы в формате [QUESTIONS]...[/QUESTIONS]. "
@@ -755,13 +766,19 @@ async def callback_agent_continue(
         provider = user["llm_provider"] or "trinity"
         temperature = float(user.get("temperature", 0.4))
         processing_msg = await callback.message.answer("🔄 Готовлю уточняющие вопросы по твоему запросу...")
+        turn = user_tasks.begin(user_id)
         try:
-            reply = await llm_service.chat_with_history(
-                user_content=user_content,
-                history=[],
-                system_prompt=system_prompt,
-                provider=provider,
-                temperature=temperature,
+            reply = await user_tasks.run(
+                user_id,
+                turn,
+                lambda: llm_service.chat_with_history(
+                    user_content=user_content,
+                    history=[],
+                    system_prompt=AGENT_SYSTEM_PROMPT_BASE,
+                    user_context=prefs_text,
+                    provider=provider,
+                    temperature=temperature,
+                ),
             )
             await processing_msg.delete()
             questions = _parse_agent_questions(reply)
@@ -791,6 +808,10 @@ async def callback_agent_continue(
                     "💡 Или напиши своё уточнение текстом — я обработаю его.",
                     reply_markup=None,
                 )
+                if speculative_replies:
+                    speculative_replies.start(
+                        user_id, **_skip_questions_request(last_user_content, provider, prefs_text or "", temperature)
+                    )
             else:
                 await callback.message.answer(
                     "Сейчас в диалоге ещё нет готового промпта. "
@@ -798,6 +819,8 @@ async def callback_agent_continue(
                     "Либо нажми «Принять промпт» и начни новый запрос.",
                     reply_markup=get_agent_result_keyboard(),
                 )
+        except SupersededError:
+            await processing_msg.delete()
         except Exception as e:
             logger.warning("Ошибка при запросе уточняющих вопросов: %s", e)
             await processing_msg.delete()
@@ -810,7 +833,6 @@ async def callback_agent_continue(
     
     # Формируем запрос агенту: проанализировать промпт и задать уточняющие вопросы
     prefs_text = _format_preferences_for_prompt(user)
-    system_prompt = (prefs_text + "\n\n" + AGENT_SYSTEM_PROMPT_BASE) if prefs_text else AGENT_SYSTEM_PROMPT_BASE
     
     user_content = (
         "Пользователь хочет уточнить и улучшить этот промпт:\n\n"
@@ -824,19 +846,29 @@ async def callback_agent_continue(
     temperature = float(user.get("temperature", 0.4))
     
     processing_msg = await callback.message.answer("🔄 Анализирую промпт и готовлю вопросы...")
+    turn = user_tasks.begin(user_id)
     
     try:
-        reply = await llm_service.chat_with_history(
-            user_content=user_content,
-            history=history,
-            system_prompt=system_prompt,
-            provider=provider,
-            temperature=temperature,
+        reply = await user_tasks.run(
+            user_id,
+            turn,
+            lambda: llm_service.chat_with_history(
+                user_content=user_content,
+                history=_compact_prompt_blocks(history),
+                system_prompt=AGENT_SYSTEM_PROMPT_BASE,
+                user_context=prefs_text,
+                provider=provider,
+                temperature=temperature,
+            ),
         )
         
         # Сохраняем в историю
-        await db_manager.add_agent_message(user_id, "user", "Хочу уточнить промпт")
-        await db_manager.add_agent_message(user_id, "assistant", reply)
+        async with user_tasks.history_lock(user_id):
+            await db_manager.add_agent_messages(
+                user_id, [("user", "Хочу уточнить промпт"), ("assistant", reply)]
+            )
+        if history_summarizer:
+            history_summarizer.schedule(user_id)
         
         await processing_msg.delete()
         
@@ -870,6 +902,11 @@ async def callback_agent_continue(
                 "💡 Или напиши своё уточнение текстом — я обработаю его.",
                 reply_markup=None
             )
+            if speculative_replies:
+                speculative_replies.start(
+                    user_id,
+                    **_skip_questions_request(previous_agent_prompt, provider, prefs_text or "", temperature),
+                )
         else:
             # Агент дал улучшенный промпт или комментарий
             if not _reply_has_prompt_block(reply):
@@ -880,19 +917,9 @@ async def callback_agent_continue(
                 )
                 return
             intro, prompt_block, outro = _parse_agent_reply(reply)
-            extra = []
-            if prompt_block.strip():
-                metrics_line = _agent_metrics_line(previous_agent_prompt, prompt_block)
-                if metrics_line:
-                    extra.append(metrics_line)
-                rouge_prev = _rouge_line("Предыдущий вариант → улучшенный", previous_agent_prompt, prompt_block)
-                if rouge_prev:
-                    extra.append(rouge_prev)
-                scores_prev = _rouge_scores(previous_agent_prompt, prompt_block)
-                rouge_r1 = scores_prev[0] if scores_prev else None
-                why_line = _why_better_line(previous_agent_prompt, prompt_block, rouge_r1)
-                if why_line:
-                    extra.append(why_line)
+            extra = await _reply_metrics_lines(
+                "Предыдущий вариант → улучшенный", previous_agent_prompt, prompt_block
+            )
             if not prompt_block.strip() and outro.strip():
                 outro = outro.strip() + "\n\n💡 Можешь написать своё уточнение текстом, и я обработаю его."
             elif not prompt_block.strip():
@@ -905,10 +932,12 @@ async def callback_agent_continue(
                 extra_lines=extra,
                 reply_markup=get_agent_result_keyboard(),
             )
+    except SupersededError:
+        await processing_msg.delete()
     except Exception as e:
         logger.exception("Ошибка при анализе промпта для уточнения: %s", e)
         await processing_msg.delete()
-        if _is_llm_provider_error(e):
+        if is_llm_provider_error(e):
             pname = PROVIDER_NAMES.get(provider, provider)
             text = (
                 f"❌ Сейчас не удаётся обратиться к модели <b>{pname}</b>.\n\n"
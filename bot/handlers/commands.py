@@ -3,14 +3,20 @@ from aiogram.types import Message
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 import logging
 import re
+import time
 
 TELEGRAM_MAX_MESSAGE_LENGTH = 4096
 
 from bot.db.sqlite_manager import SQLiteManager
-from bot.services.llm_client import LLMService
+from bot.services.llm_client import LLMService, is_llm_provider_error
+from bot.services.metrics import ReplyMetrics, compute_reply_metrics_async
+from bot.services.send_scheduler import background_sends
+from bot.services.speculative import SpeculativeReplies
+from bot.services.summarizer import HistorySummarizer
+from bot.services.user_tasks import SupersededError, UserTaskRegistry
 from bot.handlers.keyboards import (
     get_settings_keyboard,
     get_back_keyboard,
@@ -144,6 +150,28 @@ def _reply_has_prompt_block(reply: str) -> bool:
     return bool(block and block.strip())
 
 
+MAX_AGENT_QUESTIONS = 6
+MAX_QUESTION_OPTIONS = 5
+_QUESTION_LINE_RE = re.compile(r"^\d+\.\s*(.+)$")
+
+
+def _normalize_question(q: dict) -> dict:
+    """Приводит варианты ответа к диапазону 2–5; без вариантов — «Пропустить»."""
+    opts = q.get("options") or ["Пропустить"]
+    # Обрезаем до максимум 5 вариантов
+    opts = opts[:MAX_QUESTION_OPTIONS]
+    # Гарантируем минимум 2 варианта
+    if len(opts) < 2:
+        # Добавляем «Пропустить» как универсальный вариант, если его ещё нет
+        if "Пропустить" not in opts:
+            opts.append("Пропустить")
+    # Если после всех действий всё ещё 1 вариант (крайний случай) — дублируем его как второй
+    if len(opts) == 1:
+        opts.append(opts[0])
+    q["options"] = opts
+    return q
+
+
 def _parse_agent_questions(reply: str) -> list[dict] | None:
     """Извлекает список вопросов из блока [QUESTIONS]...[/QUESTIONS].
 
@@ -165,11 +193,9 @@ def _parse_agent_questions(reply: str) -> list[dict] | None:
         line = line.strip()
         if not line:
             continue
-        m = re.match(r"^\d+\.\s*(.+)$", line)
+        m = _QUESTION_LINE_RE.match(line)
         if m:
             if current_q is not None:
-                if not current_q.get("options"):
-                    current_q["options"] = ["Пропустить"]
                 questions.append(current_q)
             current_q = {"question": m.group(1).strip(), "options": []}
         elif (line.startswith("-") or line.startswith("*")) and current_q is not None:
@@ -177,33 +203,128 @@ def _parse_agent_questions(reply: str) -> list[dict] | None:
             if opt:
                 current_q["options"].append(opt)
     if current_q is not None:
-        if not current_q.get("options"):
-            current_q["options"] = ["Пропустить"]
         questions.append(current_q)
 
     if not questions:
         return None
 
-    # Нормализуем варианты ответов и ограничиваем количество вопросов
-    normalized: list[dict] = []
-    for q in questions:
-        opts = q.get("options") or []
-        # Обрезаем до максимум 5 вариантов
-        opts = opts[:5]
-        # Гарантируем минимум 2 варианта
-        if len(opts) < 2:
-            # Добавляем «Пропустить» как универсальный вариант, если его ещё нет
-            if "Пропустить" not in opts:
-                opts.append("Пропустить")
-        # Если после всех действий всё ещё 1 вариант (крайний случай) — дублируем его как второй
-        if len(opts) == 1:
-            opts.append(opts[0])
-        q["options"] = opts
-        normalized.append(q)
-
-    # Максимум 6 вопросов
-    normalized = normalized[:6]
-    return normalized
+    # Нормализуем варианты ответов и ограничиваем количество вопросов (максимум 6)
+    return [_normalize_question(q) for q in questions][:MAX_AGENT_QUESTIONS]
+
+
+class _AgentReplyStreamParser:
+    """Инкрементальный разбор ответа агента по мере поступления фрагментов.
+
+    feed() возвращает события, как только соответствующая часть закрыта:
+    ("intro", text) — текст до [QUESTIONS]/[PROMPT];
+    ("question", idx, question, is_last) — вопрос с вариантами (закрыт следующим вопросом или [/QUESTIONS]);
+    ("prompt_chunk", text) и ("prompt_done",) — содержимое блока [PROMPT];
+    ("questions_truncated",) — поток оборвался до [/QUESTIONS].
+    Вопросы нормализуются так же, как в _parse_agent_questions. Для оборванного блока
+    _parse_agent_questions возвращает None; здесь последний (незакрытый) вопрос тоже отбрасывается,
+    но вопросы, закрытые следующим вопросом, к этому моменту уже отданы.
+    """
+
+    def __init__(self):
+        self._buf = ""
+        self._mode = "intro"  # intro | questions | prompt | tail
+        self._intro = ""
+        self._current_q: dict | None = None
+        self._questions_emitted = 0
+
+    def feed(self, chunk: str) -> list[tuple]:
+        self._buf += chunk
+        events: list[tuple] = []
+        while self._step(events):
+            pass
+        return events
+
+    def close(self) -> list[tuple]:
+        """Конец потока: досылает незакрытый фрагмент промпта; незакрытый вопрос не отдаётся."""
+        events: list[tuple] = []
+        if self._mode == "questions":
+            # Начало следующего вопроса закрывает предыдущий; сам он не дописан
+            self._consume_question_line(self._buf, events)
+            self._current_q = None
+            events.append(("questions_truncated",))
+        elif self._mode == "prompt" and self._buf:
+            events.append(("prompt_chunk", self._buf))
+            events.append(("prompt_done",))
+        self._buf = ""
+        self._mode = "tail"
+        return events
+
+    def _step(self, events: list[tuple]) -> bool:
+        """Обрабатывает буфер, насколько возможно; True — состояние сменилось, нужен ещё проход."""
+        if self._mode == "intro":
+            positions = [(self._buf.find(tag), tag) for tag in (QUESTIONS_OPEN, PROMPT_OPEN)]
+            found = [(pos, tag) for pos, tag in positions if pos >= 0]
+            if not found:
+                # Хвост может оказаться началом тега — придерживаем его
+                keep = max(len(QUESTIONS_OPEN), len(PROMPT_OPEN)) - 1
+                if len(self._buf) > keep:
+                    self._intro += self._buf[:-keep]
+                    self._buf = self._buf[-keep:]
+                return False
+            pos, tag = min(found)
+            self._intro += self._buf[:pos]
+            self._buf = self._buf[pos + len(tag):]
+            if self._intro.strip():
+                events.append(("intro", self._intro.strip()))
+            self._mode = "questions" if tag == QUESTIONS_OPEN else "prompt"
+            return True
+        if self._mode == "questions":
+            close_pos = self._buf.find(QUESTIONS_CLOSE)
+            while "\n" in self._buf:
+                nl = self._buf.index("\n")
+                if 0 <= close_pos < nl:
+                    break
+                line, self._buf = self._buf[:nl], self._buf[nl + 1:]
+                close_pos = self._buf.find(QUESTIONS_CLOSE)
+                self._consume_question_line(line, events)
+            if close_pos >= 0:
+                self._consume_question_line(self._buf[:close_pos], events)
+                self._emit_current_question(events, is_last=True)
+                self._buf = self._buf[close_pos + len(QUESTIONS_CLOSE):]
+                self._mode = "tail"
+            return False
+        if self._mode == "prompt":
+            close_pos = self._buf.find(PROMPT_CLOSE)
+            if close_pos >= 0:
+                if self._buf[:close_pos]:
+                    events.append(("prompt_chunk", self._buf[:close_pos]))
+                events.append(("prompt_done",))
+                self._buf = self._buf[close_pos + len(PROMPT_CLOSE):]
+                self._mode = "tail"
+                return False
+            keep = len(PROMPT_CLOSE) - 1
+            if len(self._buf) > keep:
+                events.append(("prompt_chunk", self._buf[:-keep]))
+                self._buf = self._buf[-keep:]
+            return False
+        self._buf = ""
+        return False
+
+    def _consume_question_line(self, line: str, events: list[tuple]):
+        line = line.strip()
+        if not line:
+            return
+        m = _QUESTION_LINE_RE.match(line)
+        if m:
+            self._emit_current_question(events, is_last=False)
+            self._current_q = {"question": m.group(1).strip(), "options": []}
+        elif (line.startswith("-") or line.startswith("*")) and self._current_q is not None:
+            opt = line.lstrip("-*").strip()
+            if opt:
+                self._current_q["options"].append(opt)
+
+    def _emit_current_question(self, events: list[tuple], is_last: bool):
+        q, self._current_q = self._current_q, None
+        if q is None or self._questions_emitted >= MAX_AGENT_QUESTIONS:
+            return
+        is_last = is_last or self._questions_emitted == MAX_AGENT_QUESTIONS - 1
+        events.append(("question", self._questions_emitted, _normalize_question(q), is_last))
+        self._questions_emitted += 1
 
 
 def _parse_agent_reply(reply: str) -> tuple[str, str, str]:
@@ -234,6 +355,27 @@ def _get_previous_agent_prompt(history: list[dict]) -> str:
     return ""
 
 
+_OMITTED_PROMPT = "(текст промпта опущен — актуальная версия приведена в запросе пользователя)"
+
+
+def _compact_prompt_blocks(history: list[dict]) -> list[dict]:
+    """
+    Копия истории, в которой блоки [PROMPT]...[/PROMPT] ответов агента заменены пометкой.
+
+    Нужна, когда актуальный промпт и так целиком передаётся в user_content: иначе каждый прошлый
+    вариант промпта уходит в запрос повторно.
+    """
+    out = []
+    for msg in history:
+        content = msg.get("content", "")
+        if msg.get("role") == "assistant" and PROMPT_OPEN in content:
+            intro, _, outro = _parse_agent_reply(content)
+            content = "\n".join(p for p in (intro, PROMPT_OPEN, _OMITTED_PROMPT, PROMPT_CLOSE, outro) if p)
+            msg = {**msg, "content": content}
+        out.append(msg)
+    return out
+
+
 def _format_agent_reply_for_telegram(reply: str) -> str:
     """Разбивает ответ агента на обычный текст и блок промпта; промпт — blockquote+pre."""
     intro, prompt_block, outro = _parse_agent_reply(reply)
@@ -245,13 +387,12 @@ def _format_agent_reply_for_telegram(reply: str) -> str:
     return out.strip() or _html_escape(reply)
 
 
-def _agent_metrics_line(original: str, optimized: str) -> str | None:
-    """Строка метрик длины (символы и слова) для ответа агента. Если optimized пустой — None."""
-    if not optimized.strip():
+def _agent_metrics_line(metrics: ReplyMetrics) -> str | None:
+    """Строка метрик длины (символы и слова) для ответа агента. Если новый промпт пустой — None."""
+    if not metrics.new_len:
         return None
-    orig_len, opt_len = len(original), len(optimized)
-    orig_words = len(original.split())
-    opt_words = len(optimized.split())
+    orig_len, opt_len = metrics.original_len, metrics.new_len
+    orig_words, opt_words = metrics.original_words, metrics.new_words
     pct = ((opt_len - orig_len) / orig_len * 100) if orig_len else 0
     diff_words = opt_words - orig_words
     if pct > 20:
@@ -267,25 +408,11 @@ def _agent_metrics_line(original: str, optimized: str) -> str | None:
     )
 
 
-def _rouge_scores(reference: str, candidate: str) -> tuple[float, float] | None:
-    """Возвращает (R-1 F1, R-2 F1) или None при ошибке/пустых текстах."""
-    if not reference.strip() or not candidate.strip():
-        return None
-    try:
-        from rouge_score import rouge_scorer
-        scorer = rouge_scorer.RougeScorer(["rouge1", "rouge2"], use_stemmer=False)
-        scores = scorer.score(reference, candidate)
-        return scores["rouge1"].fmeasure, scores["rouge2"].fmeasure
-    except Exception:
-        return None
-
-
-def _rouge_line(label: str, reference: str, candidate: str) -> str:
+def _rouge_line(label: str, metrics: ReplyMetrics) -> str:
     """Строка ROUGE с подписью (исходный / предыдущий вариант) и интерпретацией."""
-    scores = _rouge_scores(reference, candidate)
-    if scores is None:
+    if metrics.rouge1 is None or metrics.rouge2 is None:
         return ""
-    r1, r2 = scores
+    r1, r2 = metrics.rouge1, metrics.rouge2
     if r1 >= 0.6:
         interp = "сохранён смысл и формулировки, аккуратное улучшение"
     elif r1 >= 0.35:
@@ -295,26 +422,13 @@ def _rouge_line(label: str, reference: str, candidate: str) -> str:
     return f"📊 {label}: R-1 {r1:.2f}, R-2 {r2:.2f} — {interp}"
 
 
-def _count_structure_markers(text: str) -> int:
-    """Число типичных структурных элементов промпта (роль, задача, формат и т.д.)."""
-    if not text or not text.strip():
-        return 0
-    lower = text.lower()
-    markers = [
-        "ты —", "ты -", "твоя задача", "задача:", "формат:", "шаги:", "ограничения:",
-        "ответь в формате", "выведи", "1.", "2.", "3.", "• ", "- ", "— "
-    ]
-    return sum(1 for m in markers if m in lower)
-
-
-def _why_better_line(original: str, new_prompt: str, rouge_r1: float | None) -> str:
+def _why_better_line(metrics: ReplyMetrics) -> str:
     """Одна фраза: почему новый вариант может быть лучше (эвристики)."""
-    if not new_prompt.strip():
+    if not metrics.new_len:
         return ""
-    orig_len, new_len = len(original), len(new_prompt)
-    orig_words, new_words = len(original.split()), len(new_prompt.split())
-    struct_orig = _count_structure_markers(original)
-    struct_new = _count_structure_markers(new_prompt)
+    orig_len, new_len = metrics.original_len, metrics.new_len
+    struct_orig, struct_new = metrics.struct_original, metrics.struct_new
+    rouge_r1 = metrics.rouge1
     reasons = []
     if struct_new > struct_orig:
         reasons.append("добавлена структура (роль, задача, формат)")
@@ -329,6 +443,24 @@ def _why_better_line(original: str, new_prompt: str, rouge_r1: float | None) ->
     return "💡 Почему может быть лучше: " + ", ".join(reasons) + "."
 
 
+async def _reply_metrics_lines(rouge_label: str, original: str, prompt_block: str) -> list[str]:
+    """Метрики длины, ROUGE и «почему лучше» под ответом агента — из одного подсчёта метрик.
+
+    Подсчёт идёт в пуле; если он не уложился в бюджет времени, ответ уходит без метрик.
+    """
+    if not prompt_block.strip():
+        return []
+    metrics = await compute_reply_metrics_async(original, prompt_block)
+    if metrics is None:
+        return []
+    lines = [
+        _agent_metrics_line(metrics),
+        _rouge_line(rouge_label, metrics),
+        _why_better_line(metrics),
+    ]
+    return [line for line in lines if line]
+
+
 async def _send_long_message(message: Message, text: str, parse_mode: str | None = None, reply_markup=None):
     """Отправляет текст одним или несколькими сообщениями, не превышая лимит Telegram."""
     if not text:
@@ -421,15 +553,56 @@ async def _send_agent_reply_safe(
         await message.answer("📋 Готово.", parse_mode="HTML", reply_markup=reply_markup)
 
 
-def _is_llm_provider_error(exc: Exception) -> bool:
-    """Проверяет, связана ли ошибка с недоступностью провайдера (403, регион и т.п.)."""
-    name = type(exc).__name__
-    msg = str(exc).lower()
-    if name in ("PermissionDeniedError", "AuthenticationError"):
-        return True
-    if "403" in msg or "not available" in msg or "your region" in msg or "provider returned error" in msg:
-        return True
-    return False
+# Telegram допускает примерно одно редактирование сообщения в секунду на чат — берём запас
+STREAM_EDIT_INTERVAL = 1.5
+_STREAM_PREVIEW_MAX = TELEGRAM_MAX_MESSAGE_LENGTH - 200
+
+
+def _strip_agent_markup(text: str) -> str:
+    for tag in (PROMPT_OPEN, PROMPT_CLOSE, QUESTIONS_OPEN, QUESTIONS_CLOSE):
+        text = text.replace(tag, "")
+    return text
+
+
+class _StreamingPreview:
+    """Колбэк on_delta для LLMService: показывает частичный ответ в сообщении «Думаю...».
+
+    Сообщение редактируется не чаще interval секунд; ошибки Telegram не прерывают генерацию.
+    """
+
+    def __init__(self, message: Message, header: str, interval: float = STREAM_EDIT_INTERVAL):
+        self.message = message
+        self.header = header
+        self.interval = interval
+        self.text = ""
+        self._shown = ""
+        self._next_edit_at = 0.0
+
+    async def __call__(self, delta: str):
+        self.text += delta
+        now = time.monotonic()
+        if now < self._next_edit_at:
+            return
+        self._next_edit_at = now + self.interval
+        text = self.text
+        # Недописанный тег в хвосте ("[PRO") не показываем
+        tail_start = text.rfind("[")
+        if tail_start >= 0 and "]" not in text[tail_start:] and len(text) - tail_start < len(QUESTIONS_CLOSE):
+            text = text[:tail_start]
+        body = _strip_agent_markup(text).strip()
+        if not body or body == self._shown:
+            return
+        if len(body) > _STREAM_PREVIEW_MAX:
+            body = "…" + body[-_STREAM_PREVIEW_MAX:]
+        try:
+            # Превью уступает очередь вопросам и ответам в других чатах
+            with background_sends():
+                await self.message.edit_text(f"{self.header}\n\n{body}")
+            self._shown = body
+        except TelegramRetryAfter as e:
+            self._next_edit_at = time.monotonic() + e.retry_after
+        except Exception as e:
+            logger.debug("Не удалось обновить превью ответа: %s", e)
 
 
 def _format_preferences_for_prompt(user: dict) -> str:
@@ -452,6 +625,25 @@ def _format_preferences_for_prompt(user: dict) -> str:
     return "Предпочтения пользователя (учитывай при улучшении промптов): " + " ".join(parts)
 
 
+def _skip_questions_request(original_request: str, provider: str, prefs: str, temperature: float) -> dict:
+    """Аргументы chat_with_history для кнопки «без вопросов» (aq_skip) — общие для заготовки и обработчика."""
+    user_content = (
+        "Пользователь хочет получить итоговый промпт СРАЗУ, без дополнительных уточняющих вопросов.\n"
+        "Сформируй промпт только на основе запроса ниже, не добавляя новых деталей.\n\n"
+        f"{original_request}\n\n"
+        "Ответ должен быть СТРОГО в виде одного блока [PROMPT]...[/PROMPT]. Не возвращай [QUESTIONS].\n"
+        "ОБЯЗАТЕЛЬНО верни результат ТОЛЬКО в формате [PROMPT] и [/PROMPT] (каждый тег на отдельной строке)."
+    )
+    return dict(
+        user_content=user_content,
+        history=[],
+        system_prompt=AGENT_SYSTEM_PROMPT_BASE,
+        user_context=prefs,
+        provider=provider,
+        temperature=temperature,
+    )
+
+
 class SettingsStates(StatesGroup):
     editing_meta_prompt = State()
     editing_context = State()
@@ -465,6 +657,92 @@ class AgentStates(StatesGroup):
     answering_questions = State()
 
 
+class _AgentStreamHandler:
+    """on_delta для режима агента: превью ответа, а вопросы из [QUESTIONS] отправляются по мере готовности.
+
+    Первый вопрос с клавиатурой уходит, пока модель ещё пишет остальные; FSM-состояние
+    выставляется до отправки, чтобы нажатия на варианты сразу обрабатывались. Если пользователь
+    уже ушёл из вопросов (нажал «Готово» или «Сразу дать промпт»), остальные вопросы не отправляются.
+    """
+
+    def __init__(
+        self,
+        message: Message,
+        state: FSMContext,
+        processing_msg: Message,
+        fsm_data: dict,
+    ):
+        self.message = message
+        self.state = state
+        self.processing_msg = processing_msg
+        self.fsm_data = fsm_data
+        self.preview = _StreamingPreview(processing_msg, "🔄 Думаю...")
+        self.parser = _AgentReplyStreamParser()
+        self.intro = ""
+        self.questions: list[dict] = []
+        self.abandoned = False
+        self._last_question_msg: Message | None = None
+
+    async def __call__(self, delta: str):
+        events = self.parser.feed(delta)
+        if not self.questions:
+            await self.preview(delta)
+        await self._handle(events)
+
+    async def finish(self) -> bool:
+        """Закрывает поток; True, если ответ был вопросами и они уже отправлены."""
+        await self._handle(self.parser.close())
+        return bool(self.questions)
+
+    async def _handle(self, events: list[tuple]):
+        for event in events:
+            if self.abandoned:
+                return
+            if event[0] == "intro":
+                self.intro = event[1]
+            elif event[0] == "questions_truncated":
+                if self._last_question_msg is None:
+                    continue
+                if await self.state.get_state() != AgentStates.answering_questions.state:
+                    self.abandoned = True
+                    return
+                # Ответ оборвался: «Готово» ставим под последний отправленный вопрос
+                idx = len(self.questions) - 1
+                data = await self.state.get_data()
+                answers = {int(k): v for k, v in (data.get("agent_answers") or {}).items()}
+                try:
+                    await self._last_question_msg.edit_reply_markup(
+                        reply_markup=get_agent_question_single_keyboard(idx, self.questions[idx], answers, True)
+                    )
+                except Exception:
+                    pass
+            elif event[0] == "question":
+                _, idx, q, is_last = event
+                if idx > 0 and await self.state.get_state() != AgentStates.answering_questions.state:
+                    self.abandoned = True
+                    return
+                self.questions.append(q)
+                if idx == 0:
+                    try:
+                        await self.processing_msg.delete()
+                    except Exception:
+                        pass
+                    await self.state.set_state(AgentStates.answering_questions)
+                    await self.state.update_data(
+                        **self.fsm_data, agent_questions=self.questions, agent_answers={}
+                    )
+                else:
+                    await self.state.update_data(agent_questions=self.questions)
+                text = _html_escape(q["question"])
+                if self.intro and idx == 0:
+                    text = _html_escape(self.intro) + "\n\n" + text
+                self._last_question_msg = await self.message.answer(
+                    text,
+                    parse_mode="HTML",
+                    reply_markup=get_agent_question_single_keyboard(idx, q, {}, is_last),
+                )
+
+
 def _parse_goal_preference(value: str | None) -> list:
     if not value or not value.strip():
         return []
@@ -584,10 +862,19 @@ async def handle_context_edit(message: Message, state: FSMContext, db_manager: S
 
 @router.message(F.text, ~F.text.startswith("/"))
 async def handle_prompt(
-    message: Message, db_manager: SQLiteManager, llm_service: LLMService, state: FSMContext
+    message: Message,
+    db_manager: SQLiteManager,
+    llm_service: LLMService,
+    state: FSMContext,
+    user_tasks: UserTaskRegistry,
+    history_summarizer: HistorySummarizer | None = None,
+    speculative_replies: SpeculativeReplies | None = None,
 ):
     user_id = message.from_user.id
     user_prompt = message.text
+    if speculative_replies:
+        # Новый текст отменяет заготовленный ответ на прошлые вопросы
+        speculative_replies.cancel(user_id)
     user = await db_manager.get_or_create_user(
         user_id,
         DEFAULT_META_PROMPT,
@@ -597,13 +884,15 @@ async def handle_prompt(
     provider = user["llm_provider"] or "trinity"
 
     if mode == "agent":
+        # Новое сообщение вытесняет незаконченный запрос: его текст войдёт в этот
+        turn = user_tasks.begin(user_id, user_prompt)
+        user_prompt = turn.text
         if await state.get_state() == AgentStates.answering_questions.state:
             await state.clear()
         processing_msg = await message.answer("🔄 Думаю...")
         try:
             history = await db_manager.get_agent_history(user_id)
             prefs_text = _format_preferences_for_prompt(user)
-            system_prompt = (prefs_text + "\n\n" + AGENT_SYSTEM_PROMPT_BASE) if prefs_text else AGENT_SYSTEM_PROMPT_BASE
             focus_parts = [msg["content"][:200].strip() for msg in history if msg.get("role") == "user"][-2:]
             focus_str = "Ранее пользователь писал: " + " | ".join(focus_parts) if focus_parts else ""
             previous_agent_prompt = _get_previous_agent_prompt(history)
@@ -621,13 +910,38 @@ async def handle_prompt(
                 # Первый запрос или история была очищена — работаем как с новым промптом
                 user_content = (focus_str + "\n\nТекущий запрос: " + user_prompt) if focus_str else user_prompt
             temperature = float(user.get("temperature", 0.4))
-            reply = await llm_service.chat_with_history(
-                user_content=user_content,
-                history=history,
-                system_prompt=system_prompt,
-                provider=provider,
-                temperature=temperature,
+            stream_handler = None
+            if llm_service.streaming_enabled:
+                stream_handler = _AgentStreamHandler(
+                    message,
+                    state,
+                    processing_msg,
+                    fsm_data=dict(
+                        agent_original_request=user_prompt,
+                        agent_provider=provider,
+                        agent_prefs=prefs_text or "",
+                    ),
+                )
+            reply = await user_tasks.run(
+                user_id,
+                turn,
+                lambda: llm_service.chat_with_history(
+                    user_content=user_content,
+                    history=_compact_prompt_blocks(history) if previous_agent_prompt else history,
+                    system_prompt=AGENT_SYSTEM_PROMPT_BASE,
+                    user_context=prefs_text,
+                    provider=provider,
+                    temperature=temperature,
+                    on_delta=stream_handler,
+                ),
             )
+            if stream_handler is not None and await stream_handler.finish():
+                # Вопросы уже отправлены по ходу генерации
+                if speculative_replies and not stream_handler.abandoned:
+                    speculative_replies.start(
+                        user_id, **_skip_questions_request(user_prompt, provider, prefs_text or "", temperature)
+                    )
+                return
             questions = _parse_agent_questions(reply)
             if questions:
                 await processing_msg.delete()
@@ -652,9 +966,17 @@ async def handle_prompt(
                             i, q, answers, i == len(questions) - 1
                         ),
                     )
+                if speculative_replies:
+                    speculative_replies.start(
+                        user_id, **_skip_questions_request(user_prompt, provider, prefs_text or "", temperature)
+                    )
                 return
-            await db_manager.add_agent_message(user_id, "user", user_prompt)
-            await db_manager.add_agent_message(user_id, "assistant", reply)
+            async with user_tasks.history_lock(user_id):
+                await db_manager.add_agent_messages(
+                    user_id, [("user", user_prompt), ("assistant", reply)]
+                )
+            if history_summarizer:
+                history_summarizer.schedule(user_id)
             await processing_msg.delete()
             if not _reply_has_prompt_block(reply):
                 await message.answer(
@@ -664,29 +986,13 @@ async def handle_prompt(
                 )
                 return
             intro, prompt_block, outro = _parse_agent_reply(reply)
-            extra = []
-            if prompt_block.strip():
-                previous_agent_prompt = _get_previous_agent_prompt(history)
-                baseline = previous_agent_prompt if previous_agent_prompt else user_prompt
-                metrics_line = _agent_metrics_line(baseline, prompt_block)
-                if metrics_line:
-                    extra.append(metrics_line)
-                if previous_agent_prompt:
-                    rouge_prev = _rouge_line("Предыдущий вариант → подправленный", previous_agent_prompt, prompt_block)
-                    if rouge_prev:
-                        extra.append(rouge_prev)
-                    scores_prev = _rouge_scores(previous_agent_prompt, prompt_block)
-                    rouge_r1 = scores_prev[0] if scores_prev else None
-                    why_line = _why_better_line(previous_agent_prompt, prompt_block, rouge_r1)
-                else:
-                    rouge_orig = _rouge_line("Похожесть на исходный запрос", user_prompt, prompt_block)
-                    if rouge_orig:
-                        extra.append(rouge_orig)
-                    scores = _rouge_scores(user_prompt, prompt_block)
-                    rouge_r1 = scores[0] if scores else None
-                    why_line = _why_better_line(user_prompt, prompt_block, rouge_r1)
-                if why_line:
-                    extra.append(why_line)
+            previous_agent_prompt = _get_previous_agent_prompt(history)
+            if previous_agent_prompt:
+                extra = await _reply_metrics_lines(
+                    "Предыдущий вариант → подправленный", previous_agent_prompt, prompt_block
+                )
+            else:
+                extra = await _reply_metrics_lines("Похожесть на исходный запрос", user_prompt, prompt_block)
             try:
                 await _send_agent_reply_safe(
                     message,
@@ -712,6 +1018,12 @@ async def handle_prompt(
                     if len(safe_text) > TELEGRAM_MAX_MESSAGE_LENGTH:
                         safe_text = safe_text[: TELEGRAM_MAX_MESSAGE_LENGTH - 50] + "\n\n… (обрезано)"
                     await message.answer(safe_text, reply_markup=get_agent_result_keyboard())
+        except SupersededError:
+            # Ответ придёт на более новое сообщение, в котором учтён и этот текст
+            try:
+                await processing_msg.delete()
+            except Exception:
+                pass
         except Exception as e:
             error_code = type(e).__name__
             logger.error(f"Ошибка в режиме агента: {e}", exc_info=True)
@@ -721,7 +1033,7 @@ async def handle_prompt(
                 "Переключитесь на другую модель в настройках или нажмите кнопку ниже."
             )
             err_text_other = f"❌ Ошибка.\nКод: {error_code}\nПопробуйте позже."
-            if _is_llm_provider_error(e):
+            if is_llm_provider_error(e):
                 from bot.handlers.callbacks import PROVIDER_NAMES
                 pname = PROVIDER_NAMES.get(provider, provider)
                 text = err_text_llm.format(pname=pname)
@@ -741,16 +1053,20 @@ async def handle_prompt(
         meta_prompt = user["meta_prompt"] or DEFAULT_META_PROMPT
         context_prompt = user["context_prompt"] or DEFAULT_CONTEXT
         prefs_text = _format_preferences_for_prompt(user)
-        if prefs_text:
-            context_prompt = prefs_text + "\n\n" + context_prompt
         temperature = float(user.get("temperature", 0.4))
 
+        preview = (
+            _StreamingPreview(processing_msg, "🔄 Обрабатываю промпт...")
+            if llm_service.streaming_enabled else None
+        )
         optimized = await llm_service.optimize_prompt(
             user_prompt,
             meta_prompt,
             context_prompt,
             provider or "trinity",
             temperature=temperature,
+            on_delta=preview,
+            user_context=prefs_text,
         )
 
         original_length = len(user_prompt)
@@ -758,8 +1074,6 @@ async def handle_prompt(
         original_words = len(user_prompt.split())
         optimized_words = len(optimized.split())
 
-        await processing_msg.delete()
-
         escaped = _html_escape(optimized)
         header = "✨ <b>Оптимизированный промпт:</b> (нажми на блок, чтобы скопировать)"
         pct = ((optimized_length - original_length) / original_length * 100) if original_length else 0
@@ -777,12 +1091,23 @@ async def handle_prompt(
         )
         prompt_block = f"<blockquote><pre>{escaped}</pre></blockquote>"
         if len(escaped) <= 3500:
-            await message.answer(
-                f"{header}\n\n{prompt_block}\n\n{metrics}",
-                parse_mode="HTML",
-                reply_markup=get_result_nav_keyboard()
-            )
+            # Превью в сообщении «Обрабатываю...» заменяется итоговым оформлением
+            final_text = f"{header}\n\n{prompt_block}\n\n{metrics}"
+            try:
+                await processing_msg.edit_text(
+                    final_text,
+                    parse_mode="HTML",
+                    reply_markup=get_result_nav_keyboard()
+                )
+            except TelegramBadRequest:
+                await processing_msg.delete()
+                await message.answer(
+                    final_text,
+                    parse_mode="HTML",
+                    reply_markup=get_result_nav_keyboard()
+                )
         else:
+            await processing_msg.delete()
             await message.answer(header, parse_mode="HTML")
             await message.answer(prompt_block, parse_mode="HTML")
             await message.answer(metrics, reply_markup=get_result_nav_keyboard())
@@ -796,7 +1121,7 @@ async def handle_prompt(
     except Exception as e:
         error_code = type(e).__name__
         logger.error(f"Ошибка при обработке промпта: {e}", exc_info=True)
-        if _is_llm_provider_error(e):
+        if is_llm_provider_error(e):
             from bot.handlers.callbacks import PROVIDER_NAMES
             pname = PROVIDER_NAMES.get(provider or "gemini", provider or "gemini")
             text = (
@@ -49,6 +49,7 @@ def get_temperature_keyboard(current: float) -> InlineKeyboardMarkup:
 
 def get_llm_keyboard(current_provider: str) -> InlineKeyboardMarkup:
     providers = (
+        "auto",
         "deepseek",
         "openai",
         "gemini",
@@ -61,6 +62,7 @@ def get_llm_keyboard(current_provider: str) -> InlineKeyboardMarkup:
         "qwen3",
     )
     labels = {
+        "auto": "⚡ Авто (самая быстрая)",
         "deepseek": "DeepSeek",
         "openai": "ChatGPT",
         "gemini": "Gemini",
@@ -3,12 +3,25 @@ import logging
 import os
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.fsm.storage.memory import MemoryStorage
 
+from bot.db.fsm_storage import SQLiteStorage
 from bot.db.sqlite_manager import SQLiteManager
-from bot.services.llm_client import LLMService
+from bot.services.circuit_breaker import CircuitBreakers
+from bot.services.http_transport import build_http_client
+from bot.services.llm_cache import LLMResponseCache
+from bot.services.llm_client import DEFAULT_FALLBACK_PROVIDERS, OPENROUTER_MODELS, LLMService, parse_fallback_chains
+from bot.services.metrics import configure_metrics_executor, configure_rouge, shutdown_metrics_executor
+from bot.services.rate_limit import ModelLimits, RateLimiter, parse_model_limits
+from bot.services.send_scheduler import SendScheduler
+from bot.services.speculative import SpeculativeReplies
+from bot.services.summarizer import HistorySummarizer
+from bot.services.user_tasks import UserTaskRegistry
 from bot.handlers import commands_router, callbacks_router
 from bot.handlers.commands import DEFAULT_META_PROMPT, DEFAULT_CONTEXT
+from bot.webhook import run_webhook
 
 load_dotenv()
 
@@ -28,19 +41,161 @@ async def main():
     if not openrouter_key:
         raise ValueError("OPENROUTER_API_KEY не найден в переменных окружения")
 
-    bot = Bot(token=bot_token)
-    dp = Dispatcher(storage=MemoryStorage())
-
+    bot_mode = os.getenv("BOT_MODE", "polling")
+    if bot_mode not in ("polling", "webhook"):
+        raise ValueError(f"Неизвестный BOT_MODE: {bot_mode!r} (ожидается polling или webhook)")
+    webhook_mode = bot_mode == "webhook"
+    webhook_url = os.getenv("WEBHOOK_URL") or None
+    webhook_secret = os.getenv("WEBHOOK_SECRET") or None
+    if webhook_url and not webhook_secret:
+        # Без секрета кто угодно может слать на публичный адрес поддельные обновления
+        raise ValueError("WEBHOOK_URL задан без WEBHOOK_SECRET")
+
+    # TELEGRAM_API_SERVER — свой Bot API сервер (или заглушка для локальной проверки вебхука)
+    api_server = os.getenv("TELEGRAM_API_SERVER")
+    session = AiohttpSession(api=TelegramAPIServer.from_base(api_server)) if api_server else None
+    bot = Bot(token=bot_token, session=session)
+    # Все отправки в Telegram — через общую очередь с лимитами на бота и на чат
+    send_scheduler = SendScheduler(
+        global_rate=float(os.getenv("TG_GLOBAL_RATE", "30")),
+        chat_rate=float(os.getenv("TG_CHAT_RATE", "1")),
+        chat_burst=int(os.getenv("TG_CHAT_BURST", "5")),
+        group_rate=float(os.getenv("TG_GROUP_RATE", str(20 / 60))),
+        max_retries=int(os.getenv("TG_MAX_RETRIES", "3")),
+    )
+    bot.session.middleware(send_scheduler)
+
+    # За балансировщиком обновления одного пользователя попадают в разные экземпляры с общей базой:
+    # кэш пользователей и отложенная запись FSM дали бы им устаревшие настройки и состояние диалога
+    shared_state_default = "0" if webhook_mode else None
     db_path = os.getenv("DB_PATH", "bot.db")
-    db_manager = SQLiteManager(db_path=db_path)
+    db_pool_size = int(os.getenv("DB_POOL_SIZE", "4"))
+    db_manager = SQLiteManager(
+        db_path=db_path,
+        pool_size=db_pool_size,
+        user_cache_size=int(os.getenv("USER_CACHE_SIZE", "10000")),
+        user_cache_ttl=float(os.getenv("USER_CACHE_TTL", shared_state_default or "300")),
+    )
     await db_manager.init_db()
 
+    if os.getenv("FSM_STORAGE", "sqlite") == "memory":
+        if webhook_mode:
+            logger.warning("FSM_STORAGE=memory в режиме вебхука: состояние диалога не видно другим экземплярам")
+        storage = MemoryStorage()
+    else:
+        storage = SQLiteStorage(
+            db_manager,
+            state_ttl=float(os.getenv("FSM_STATE_TTL", "86400")),
+            flush_interval=float(os.getenv("FSM_FLUSH_INTERVAL", shared_state_default or "1")),
+        )
+    dp = Dispatcher(storage=storage)
+
+    configure_rouge(
+        backend=os.getenv("ROUGE_BACKEND", "native"),
+        tokenizer=os.getenv("ROUGE_TOKENIZER", "compat"),
+    )
+    configure_metrics_executor(
+        kind=os.getenv("METRICS_EXECUTOR", "thread"),
+        max_workers=int(os.getenv("METRICS_MAX_WORKERS", "2")),
+        timeout=float(os.getenv("METRICS_TIMEOUT", "2")),
+    )
+
+    llm_cache = None
+    if os.getenv("LLM_CACHE", "1") != "0":
+        llm_cache = LLMResponseCache(
+            db_manager if os.getenv("LLM_CACHE_PERSISTENT", "1") != "0" else None,
+            max_size=int(os.getenv("LLM_CACHE_SIZE", "1000")),
+            ttl=float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600))),
+            max_db_entries=int(os.getenv("LLM_CACHE_DB_MAX_ENTRIES", "20000")),
+            max_temperature=float(os.getenv("LLM_CACHE_MAX_TEMPERATURE", "0.5")),
+        )
+
+    model_limits = parse_model_limits(os.getenv("LLM_MODEL_LIMITS", ""))
+    rate_limiter = RateLimiter(
+        default=ModelLimits(
+            int(os.getenv("LLM_MAX_CONCURRENT", "8")),
+            float(os.getenv("LLM_RPM", "120")),
+        ),
+        free=ModelLimits(
+            int(os.getenv("LLM_FREE_MAX_CONCURRENT", "2")),
+            float(os.getenv("LLM_FREE_RPM", "16")),
+        ),
+        # В LLM_MODEL_LIMITS можно писать и короткое имя провайдера (trinity), и id модели
+        overrides={OPENROUTER_MODELS.get(name, name): limits for name, limits in model_limits.items()},
+        queue_timeout=float(os.getenv("LLM_QUEUE_TIMEOUT", "30")),
+    )
+
+    connect_timeout = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+    read_timeout = float(os.getenv("LLM_READ_TIMEOUT", "120"))
+    http_client = build_http_client(
+        max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "50")),
+        max_keepalive=int(os.getenv("HTTP_MAX_KEEPALIVE", "20")),
+        keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "120")),
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+        http2=os.getenv("HTTP2", "1") != "0",
+    )
+
     llm_service = LLMService()
-    llm_service.initialize(openrouter_api_key=openrouter_key)
+    llm_service.initialize(
+        openrouter_api_key=openrouter_key,
+        streaming=os.getenv("LLM_STREAMING", "1") != "0",
+        cache=llm_cache,
+        coalesce=os.getenv("LLM_COALESCE", "1") != "0",
+        rate_limiter=rate_limiter,
+        fallback_chains=parse_fallback_chains(os.getenv("LLM_FALLBACK_CHAINS", "")),
+        default_fallback=[
+            p.strip() for p in os.getenv("LLM_FALLBACK", ",".join(DEFAULT_FALLBACK_PROVIDERS)).split(",") if p.strip()
+        ],
+        hedge_delay=float(os.getenv("LLM_HEDGE_DELAY", "0")),
+        breakers=CircuitBreakers(
+            failure_threshold=int(os.getenv("LLM_BREAKER_FAILURES", "3")),
+            recovery_timeout=float(os.getenv("LLM_BREAKER_RECOVERY", "30")),
+        ) if os.getenv("LLM_BREAKER", "1") != "0" else None,
+        auto_tier=os.getenv("LLM_AUTO_TIER", "standard"),
+        http_client=http_client,
+        max_retries=int(os.getenv("LLM_MAX_RETRIES", "1")),
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+        stream_read_timeout=float(os.getenv("LLM_STREAM_READ_TIMEOUT", "30")),
+        token_budget=int(os.getenv("LLM_TOKEN_BUDGET", "6000")),
+        # LLM_TOKEN_BUDGETS=trinity=3000,qwen3=8000 — бюджеты отдельных провайдеров
+        token_budgets={
+            name.strip(): int(value)
+            for name, _, value in (
+                item.partition("=") for item in os.getenv("LLM_TOKEN_BUDGETS", "").split(",") if "=" in item
+            )
+        },
+    )
+    llm_service.start_keep_warm(float(os.getenv("LLM_WARM_INTERVAL", "60")))
+
+    history_summarizer = None
+    if os.getenv("AGENT_SUMMARY", "0") == "1":
+        history_summarizer = HistorySummarizer(
+            db_manager,
+            llm_service,
+            provider=os.getenv("AGENT_SUMMARY_PROVIDER", "gemini"),
+            trigger_tokens=int(os.getenv("AGENT_SUMMARY_TRIGGER_TOKENS", "2500")),
+            keep_recent=int(os.getenv("AGENT_SUMMARY_KEEP_RECENT", "4")),
+        )
+
+    # Заготовка промпта «без вопросов», пока пользователь отвечает на вопросы агента (лишний запрос к модели)
+    speculative_replies = None
+    if os.getenv("AGENT_SPECULATIVE_SKIP", "0") == "1":
+        speculative_replies = SpeculativeReplies(
+            llm_service, ttl=float(os.getenv("AGENT_SPECULATIVE_TTL", "900"))
+        )
+
+    # Новое сообщение пользователя отменяет его незаконченный запрос к модели; USER_DEBOUNCE —
+    # пауза в секундах, за которую несколько сообщений подряд склеиваются в один запрос
+    user_tasks = UserTaskRegistry(debounce=float(os.getenv("USER_DEBOUNCE", "0")))
 
     async def inject_dependencies(handler, event, data):
         data["db_manager"] = db_manager
         data["llm_service"] = llm_service
+        data["history_summarizer"] = history_summarizer
+        data["speculative_replies"] = speculative_replies
+        data["user_tasks"] = user_tasks
         return await handler(event, data)
 
     dp.message.middleware.register(inject_dependencies)
@@ -49,9 +204,39 @@ async def main():
     dp.include_router(commands_router)
     dp.include_router(callbacks_router)
 
-    logger.info("Бот запущен")
-    
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    logger.info(f"Бот запущен (режим: {bot_mode})")
+
+    try:
+        if webhook_mode:
+            await run_webhook(
+                dp,
+                bot,
+                host=os.getenv("WEBHOOK_HOST", "0.0.0.0"),
+                port=int(os.getenv("WEBHOOK_PORT", "8080")),
+                path=os.getenv("WEBHOOK_PATH", "/webhook"),
+                secret_token=webhook_secret,
+                base_url=webhook_url,
+            )
+        else:
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        if history_summarizer is not None:
+            await history_summarizer.close()
+        if speculative_replies is not None:
+            logger.info(f"Заготовки ответов: {speculative_replies.stats()}")
+            await speculative_replies.close()
+        if llm_cache is not None:
+            logger.info(f"Кэш LLM: {llm_cache.stats()}")
+        logger.info(f"Кэш пользователей: {db_manager.get_cache_stats()}")
+        logger.info(f"Запросы пользователей: {user_tasks.stats()}")
+        logger.info(f"Отправка в Telegram: {send_scheduler.stats()}")
+        logger.info(f"Очереди к моделям: {llm_service.get_rate_limit_stats()}")
+        logger.info(f"Автоматы моделей: {llm_service.get_breaker_stats()}")
+        logger.info(f"Задержки моделей: {llm_service.get_model_stats()}")
+        await llm_service.close()
+        await storage.close()
+        await db_manager.close()
+        shutdown_metrics_executor()
 
 
 if __name__ == "__main__":
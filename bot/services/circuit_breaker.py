@@ -0,0 +1,122 @@
+import logging
+import time
+from typing import Any, Dict
+
+logger = logging.getLogger(__name__)
+
+BREAKER_FAILURE_THRESHOLD = 3
+BREAKER_RECOVERY_TIMEOUT = 30.0
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Модель отключена автоматом после серии ошибок; запрос не отправлялся."""
+
+
+class CircuitBreaker:
+    """
+    Автомат одной модели: closed → open после failure_threshold ошибок подряд.
+
+    В состоянии open запросы сразу получают CircuitOpenError. Через recovery_timeout один запрос
+    пропускается пробным (half_open): успех закрывает автомат, ошибка снова открывает его.
+    Пока пробный запрос в работе, остальные тоже отклоняются.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+        recovery_timeout: float = BREAKER_RECOVERY_TIMEOUT,
+    ):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.recovery_timeout = recovery_timeout
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self.rejected = 0
+        self.trips = 0
+
+    @property
+    def allows_request(self) -> bool:
+        """Пропустит ли автомат запрос сейчас (без смены состояния)."""
+        if self.state == STATE_CLOSED:
+            return True
+        if self.state == STATE_OPEN:
+            return time.monotonic() >= self.opened_at + self.recovery_timeout
+        return not self._probe_in_flight
+
+    def before_request(self):
+        """Пропускает запрос или поднимает CircuitOpenError."""
+        if self.state == STATE_CLOSED:
+            return
+        remaining = self.opened_at + self.recovery_timeout - time.monotonic()
+        if self.state == STATE_OPEN and remaining <= 0:
+            self.state = STATE_HALF_OPEN
+            logger.info(f"Модель {self.name}: пробный запрос после отключения")
+        if self.state == STATE_HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return
+        self.rejected += 1
+        raise CircuitOpenError(
+            f"Модель {self.name} временно отключена после ошибок провайдера "
+            f"(повторная проверка через {max(remaining, 0):.0f} с)"
+        )
+
+    def record_success(self):
+        if self.state != STATE_CLOSED:
+            logger.info(f"Модель {self.name} снова доступна")
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == STATE_HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != STATE_OPEN:
+                self.trips += 1
+                logger.warning(
+                    f"Модель {self.name} отключена на {self.recovery_timeout:g} с после {self.failures} ошибок"
+                )
+            self.state = STATE_OPEN
+            self.opened_at = time.monotonic()
+        self._probe_in_flight = False
+
+    def release(self):
+        """Запрос завершился без вердикта о модели (отмена, ошибка запроса): пробный слот освобождается."""
+        self._probe_in_flight = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "trips": self.trips,
+            "rejected": self.rejected,
+        }
+
+
+class CircuitBreakers:
+    """Набор CircuitBreaker по id модели с общими настройками."""
+
+    def __init__(
+        self,
+        failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+        recovery_timeout: float = BREAKER_RECOVERY_TIMEOUT,
+    ):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def for_model(self, model: str) -> CircuitBreaker:
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = CircuitBreaker(model, self.failure_threshold, self.recovery_timeout)
+            self._breakers[model] = breaker
+        return breaker
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {model: breaker.stats() for model, breaker in self._breakers.items()}
@@ -0,0 +1,52 @@
+import importlib.util
+import logging
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+HTTP_MAX_CONNECTIONS = 50
+HTTP_MAX_KEEPALIVE = 20
+# Сколько держать простаивающее соединение открытым, секунд
+HTTP_KEEPALIVE_EXPIRY = 120.0
+HTTP_CONNECT_TIMEOUT = 5.0
+# Обычный запрос ждёт весь ответ целиком, поток — только паузу между фрагментами
+HTTP_READ_TIMEOUT = 120.0
+HTTP_STREAM_READ_TIMEOUT = 30.0
+HTTP_WRITE_TIMEOUT = 10.0
+# Ожидание свободного соединения в пуле httpx
+HTTP_POOL_TIMEOUT = 10.0
+# Повторы внутри openai-клиента; дальше работает переключение на резервную модель
+LLM_MAX_RETRIES = 1
+
+
+def http2_available() -> bool:
+    """HTTP/2 в httpx требует пакет h2 (pip install httpx[http2])."""
+    return importlib.util.find_spec("h2") is not None
+
+
+def request_timeout(read: float, connect: float = HTTP_CONNECT_TIMEOUT) -> httpx.Timeout:
+    return httpx.Timeout(read, connect=connect, write=HTTP_WRITE_TIMEOUT, pool=HTTP_POOL_TIMEOUT)
+
+
+def build_http_client(
+    max_connections: int = HTTP_MAX_CONNECTIONS,
+    max_keepalive: int = HTTP_MAX_KEEPALIVE,
+    keepalive_expiry: float = HTTP_KEEPALIVE_EXPIRY,
+    connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+    read_timeout: float = HTTP_READ_TIMEOUT,
+    http2: bool = True,
+) -> httpx.AsyncClient:
+    """Общий httpx-клиент для OpenRouter: пул keep-alive соединений и HTTP/2, если установлен h2."""
+    use_http2 = http2 and http2_available()
+    if http2 and not use_http2:
+        logger.info("Пакет h2 не установлен — соединения с OpenRouter по HTTP/1.1")
+    return httpx.AsyncClient(
+        http2=use_http2,
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        ),
+        timeout=request_timeout(read_timeout, connect_timeout),
+    )
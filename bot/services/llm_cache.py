@@ -0,0 +1,118 @@
+import hashlib
+import json
+import logging
+import time
+from typing import Any, Dict, Optional
+
+from bot.db.cache import TTLCache
+from bot.db.sqlite_manager import SQLiteManager
+
+logger = logging.getLogger(__name__)
+
+LLM_CACHE_SIZE = 1000
+LLM_CACHE_TTL = 7 * 24 * 3600.0
+LLM_CACHE_DB_MAX_ENTRIES = 20000
+# Выше этой температуры ответы заметно различаются от запроса к запросу — кэш не используется
+LLM_CACHE_MAX_TEMPERATURE = 0.5
+LLM_CACHE_CLEANUP_INTERVAL = 3600.0
+
+
+class LLMResponseCache:
+    """
+    Кэш ответов optimize_prompt: LRU в памяти процесса + таблица llm_cache в SQLite.
+
+    Ключ — хэш (model, meta_prompt, context_prompt, user_prompt, temperature). Персистентный
+    уровень переживает рестарт бота и ограничен max_db_entries (вытесняются самые старые записи).
+    Ошибки БД не ломают запрос к LLM: кэш просто пропускается.
+    """
+
+    def __init__(
+        self,
+        db_manager: Optional[SQLiteManager] = None,
+        max_size: int = LLM_CACHE_SIZE,
+        ttl: float = LLM_CACHE_TTL,
+        max_db_entries: int = LLM_CACHE_DB_MAX_ENTRIES,
+        max_temperature: float = LLM_CACHE_MAX_TEMPERATURE,
+        cleanup_interval: float = LLM_CACHE_CLEANUP_INTERVAL,
+    ):
+        self.db_manager = db_manager
+        self.ttl = ttl
+        self.max_db_entries = max_db_entries
+        self.max_temperature = max_temperature
+        self.cleanup_interval = cleanup_interval
+        self._memory = TTLCache(max_size=max_size, ttl=ttl)
+        self._last_cleanup = time.monotonic()
+        self.db_hits = 0
+        self.bypassed = 0
+        self.stores = 0
+        self.errors = 0
+
+    @staticmethod
+    def make_key(
+        model: str, meta_prompt: str, context_prompt: Optional[str], user_prompt: str, temperature: float
+    ) -> str:
+        payload = json.dumps(
+            [model, meta_prompt, context_prompt or "", user_prompt, round(float(temperature), 3)],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def accepts(self, temperature: float) -> bool:
+        """False — температура выше порога, запрос идёт мимо кэша."""
+        if temperature > self.max_temperature:
+            self.bypassed += 1
+            return False
+        return True
+
+    async def get(self, key: str) -> Optional[str]:
+        value = self._memory.get(key)
+        if value is not None or self.db_manager is None:
+            return value
+        try:
+            value = await self.db_manager.get_llm_cache_entry(key, time.time())
+        except Exception as e:
+            self.errors += 1
+            logger.warning("Кэш LLM: чтение из БД не удалось: %s", e)
+            return None
+        if value is not None:
+            self.db_hits += 1
+            self._memory.set(key, value)
+        return value
+
+    async def set(self, key: str, model: str, response: str):
+        self._memory.set(key, response)
+        self.stores += 1
+        if self.db_manager is None:
+            return
+        now = time.time()
+        try:
+            await self.db_manager.save_llm_cache_entry(
+                key, model, response, now, now + self.ttl, self.max_db_entries
+            )
+            if time.monotonic() - self._last_cleanup >= self.cleanup_interval:
+                self._last_cleanup = time.monotonic()
+                removed = await self.db_manager.delete_expired_llm_cache_entries(now)
+                if removed:
+                    logger.info(f"Кэш LLM: удалено истёкших записей: {removed}")
+        except Exception as e:
+            self.errors += 1
+            logger.warning("Кэш LLM: запись в БД не удалась: %s", e)
+
+    def stats(self) -> Dict[str, Any]:
+        memory = self._memory.stats()
+        # Промах памяти, закрытый из БД, для кэша в целом — попадание
+        hits = memory["hits"] + self.db_hits
+        misses = memory["misses"] - self.db_hits
+        total = hits + misses
+        return {
+            "memory_size": memory["size"],
+            "memory_max_size": memory["max_size"],
+            "memory_hits": memory["hits"],
+            "db_hits": self.db_hits,
+            "misses": misses,
+            "evictions": memory["evictions"],
+            "bypassed": self.bypassed,
+            "stores": self.stores,
+            "errors": self.errors,
+            "hit_rate": (hits / total) if total else 0.0,
+        }
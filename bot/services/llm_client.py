@@ -1,7 +1,26 @@
+import asyncio
+import hashlib
+import json
 import logging
-from typing import Optional, Dict, Any, List
+import time
+from typing import Optional, Dict, Any, List, Callable, Awaitable, Tuple
+import httpx
 from openai import AsyncOpenAI
 
+from bot.services.circuit_breaker import CircuitBreakers
+from bot.services.http_transport import (
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    HTTP_STREAM_READ_TIMEOUT,
+    LLM_MAX_RETRIES,
+    build_http_client,
+    request_timeout,
+)
+from bot.services.llm_cache import LLMResponseCache
+from bot.services.model_stats import ModelStatsRegistry
+from bot.services.rate_limit import RateLimiter
+from bot.services.tokens import estimate_messages_tokens, trim_to_budget
+
 logger = logging.getLogger(__name__)
 
 OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
@@ -16,22 +35,586 @@ OPENROUTER_MODELS = {
     "gpt5nano": "openai/gpt-5-nano",
     "deepseek_r1t": "tngtech/deepseek-r1t-chimera:free",
     "qwen3": "qwen/qwen3-235b-a22b-2507",
+    # Модель выбирает LLMService по текущей скорости (см. MODEL_TIERS). "@auto" — не id модели
+    # OpenRouter (у тех нет "@"): он служит только ключом кэша и объединения одинаковых запросов
+    "auto": "@auto",
+}
+AUTO_PROVIDER = "auto"
+AUTO_MODEL = OPENROUTER_MODELS[AUTO_PROVIDER]
+
+# Уровни качества для auto: запрос уходит самой быстрой исправной модели уровня
+MODEL_TIERS = {
+    "economy": ("gemini", "nemo", "mimo", "gpt5nano", "trinity", "deepseek_r1t"),
+    "standard": ("gemini", "openai", "deepseek", "grok"),
+    "premium": ("deepseek", "grok", "qwen3"),
+}
+DEFAULT_AUTO_TIER = "standard"
+
+# Бюджет токенов на весь запрос агента (system + история + новое сообщение); историю, не
+# влезающую в бюджет, обрезаем со старых сообщений. Бесплатные модели заметно медленнее
+# на длинном контексте, поэтому им бюджет меньше.
+DEFAULT_PROMPT_TOKEN_BUDGET = 6000
+PROMPT_TOKEN_BUDGETS = {
+    "trinity": 3000,
+    "deepseek_r1t": 3000,
+    "nemo": 4000,
 }
 
+# Модели, которым кэш префикса нужно включать явно разметкой cache_control (OpenRouter передаёт её
+# провайдеру). OpenAI, DeepSeek, Grok кэшируют одинаковый префикс сами — им разметка не нужна.
+CACHE_CONTROL_PREFIXES = ("anthropic/", "google/")
+
+# Простаивающее дольше этого соединение прогревается заново, чтобы не платить за TLS-рукопожатие
+LLM_WARM_INTERVAL = 60.0
+
+
+# Резервные провайдеры по умолчанию: на них переключаемся, если основная модель недоступна.
+# Пусто — запрос остаётся на выбранной пользователем модели (резерв включается через LLM_FALLBACK)
+DEFAULT_FALLBACK_PROVIDERS: Tuple[str, ...] = ()
+
+# Ошибки, после которых имеет смысл повторить запрос на другой модели
+_TRANSIENT_ERROR_NAMES = (
+    "APIConnectionError", "APITimeoutError", "RateLimitError", "InternalServerError", "LLMQueueTimeoutError",
+    "CircuitOpenError",
+)
+# Ошибки самой модели, а не нашей очереди или автомата — по ним срабатывает CircuitBreaker
+_LOCAL_ERROR_NAMES = ("LLMQueueTimeoutError", "CircuitOpenError")
+
+
+def is_llm_provider_error(exc: Exception) -> bool:
+    """Проверяет, связана ли ошибка с недоступностью провайдера (403, регион, перегрузка очереди и т.п.)."""
+    name = type(exc).__name__
+    msg = str(exc).lower()
+    if name in ("PermissionDeniedError", "AuthenticationError", "LLMQueueTimeoutError", "CircuitOpenError"):
+        return True
+    if "403" in msg or "not available" in msg or "your region" in msg or "provider returned error" in msg:
+        return True
+    return False
+
+
+def _should_fall_back(exc: BaseException) -> bool:
+    if not isinstance(exc, Exception):
+        return False
+    return type(exc).__name__ in _TRANSIENT_ERROR_NAMES or is_llm_provider_error(exc)
+
+
+def _counts_against_model(exc: BaseException) -> bool:
+    return _should_fall_back(exc) and type(exc).__name__ not in _LOCAL_ERROR_NAMES
+
+
+def parse_fallback_chains(spec: str) -> Dict[str, List[str]]:
+    """Разбирает строку вида "trinity=gemini>openai;qwen3=deepseek" (провайдер=резерв1>резерв2)."""
+    chains: Dict[str, List[str]] = {}
+    for item in spec.split(";"):
+        name, sep, value = item.partition("=")
+        if not sep or not name.strip():
+            continue
+        chains[name.strip()] = [p.strip() for p in value.split(">") if p.strip()]
+    return chains
+
+
+def _cached_part(text: str) -> Dict[str, Any]:
+    """Текстовая часть сообщения, после которой провайдер может закэшировать префикс запроса."""
+    return {"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}
+
+
+def _prepare_messages(model: str, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Сообщения в формате конкретной модели.
+
+    Внутри LLMService статичные части запроса размечены cache_control. Для моделей без явного
+    кэширования части склеиваются обратно в строку — запрос получается побайтно тем же, что и
+    без разметки.
+    """
+    if model.startswith(CACHE_CONTROL_PREFIXES):
+        return messages
+    out = []
+    for msg in messages:
+        content = msg["content"]
+        if isinstance(content, list):
+            msg = {**msg, "content": "".join(part.get("text", "") for part in content)}
+        out.append(msg)
+    return out
+
+
+def _usage_counts(usage: Any) -> Tuple[int, int, int]:
+    """(prompt_tokens, cached_tokens, completion_tokens) из usage ответа OpenRouter."""
+    if usage is None:
+        return 0, 0, 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) if details is not None else 0
+    return (
+        getattr(usage, "prompt_tokens", 0) or 0,
+        cached or 0,
+        getattr(usage, "completion_tokens", 0) or 0,
+    )
+
+
+# Колбэк потокового режима: получает очередной фрагмент текста по мере генерации
+DeltaCallback = Callable[[str], Awaitable[None]]
+
+
+class _Subscriber:
+    """Получатель потока общего запроса; lock сохраняет порядок фрагментов при догоняющем повторе."""
+
+    def __init__(self, on_delta: Optional[DeltaCallback]):
+        self.on_delta = on_delta
+        self.lock = asyncio.Lock()
+        self.delivered = False
+        self.failed = False
+
+    async def send(self, text: str):
+        if self.on_delta is None or self.failed:
+            return
+        async with self.lock:
+            try:
+                await self.on_delta(text)
+                self.delivered = True
+            except Exception as e:
+                # Ошибка отображения у одного ожидающего не должна обрывать поток остальным
+                self.failed = True
+                logger.warning("Колбэк потока отключён после ошибки: %s", e)
+
+
+class _InFlight:
+    """Запрос к OpenRouter, который ждут один или несколько одинаковых вызовов."""
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.parts: List[str] = []
+        self.subscribers: List[_Subscriber] = []
+        self.waiters = 0
+
+    async def fanout(self, delta: str):
+        self.parts.append(delta)
+        for subscriber in list(self.subscribers):
+            await subscriber.send(delta)
+
 
 class LLMService:
     def __init__(self):
         self.client: Optional[AsyncOpenAI] = None
+        self.streaming_enabled = True
+        self.cache: Optional[LLMResponseCache] = None
+        self.coalesce_enabled = True
+        self._in_flight: Dict[str, _InFlight] = {}
+        self.coalesced_requests = 0
+        self.rate_limiter: Optional[RateLimiter] = None
+        self.fallback_chains: Dict[str, List[str]] = {}
+        self.default_fallback: List[str] = list(DEFAULT_FALLBACK_PROVIDERS)
+        self.hedge_delay = 0.0
+        self.fallback_requests = 0
+        self.hedged_requests = 0
+        self.breakers: Optional[CircuitBreakers] = None
+        self.model_stats = ModelStatsRegistry()
+        self.auto_tier = DEFAULT_AUTO_TIER
+        self.http_client: Optional[httpx.AsyncClient] = None
+        self.connect_timeout = HTTP_CONNECT_TIMEOUT
+        self.read_timeout = HTTP_READ_TIMEOUT
+        self.stream_read_timeout = HTTP_STREAM_READ_TIMEOUT
+        self._last_request_at = 0.0
+        self._warm_task: Optional[asyncio.Task] = None
+        self.default_token_budget = DEFAULT_PROMPT_TOKEN_BUDGET
+        self.token_budgets: Dict[str, int] = dict(PROMPT_TOKEN_BUDGETS)
 
-    def initialize(self, openrouter_api_key: str):
+    def initialize(
+        self,
+        openrouter_api_key: str,
+        streaming: bool = True,
+        cache: Optional[LLMResponseCache] = None,
+        coalesce: bool = True,
+        rate_limiter: Optional[RateLimiter] = None,
+        fallback_chains: Optional[Dict[str, List[str]]] = None,
+        default_fallback: Optional[List[str]] = None,
+        hedge_delay: float = 0.0,
+        breakers: Optional[CircuitBreakers] = None,
+        auto_tier: str = DEFAULT_AUTO_TIER,
+        http_client: Optional[httpx.AsyncClient] = None,
+        max_retries: int = LLM_MAX_RETRIES,
+        connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+        read_timeout: float = HTTP_READ_TIMEOUT,
+        stream_read_timeout: float = HTTP_STREAM_READ_TIMEOUT,
+        token_budget: Optional[int] = None,
+        token_budgets: Optional[Dict[str, int]] = None,
+    ):
+        self.http_client = http_client or build_http_client(
+            connect_timeout=connect_timeout, read_timeout=read_timeout
+        )
+        # Таймаут на запрос заменяет таймаут клиента целиком, поэтому connect передаётся в каждый запрос
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.stream_read_timeout = stream_read_timeout
+        if token_budget is not None:
+            self.default_token_budget = token_budget
+        if token_budgets:
+            self.token_budgets.update(token_budgets)
         self.client = AsyncOpenAI(
             api_key=openrouter_api_key,
             base_url=OPENROUTER_BASE_URL,
+            http_client=self.http_client,
+            max_retries=max_retries,
         )
+        self.streaming_enabled = streaming
+        self.cache = cache
+        self.coalesce_enabled = coalesce
+        self.rate_limiter = rate_limiter
+        # Цепочки задаются короткими именами провайдеров, внутри храним id моделей
+        self.fallback_chains = {
+            self._get_model_id(name): [self._get_model_id(p) for p in chain if p in OPENROUTER_MODELS]
+            for name, chain in (fallback_chains or {}).items()
+            if name in OPENROUTER_MODELS
+        }
+        if default_fallback is not None:
+            self.default_fallback = [p for p in default_fallback if p in OPENROUTER_MODELS]
+        self.hedge_delay = hedge_delay
+        self.breakers = breakers
+        if auto_tier not in MODEL_TIERS:
+            raise ValueError(f"Неизвестный уровень моделей для auto: {auto_tier}")
+        self.auto_tier = auto_tier
+
+    async def warm_up(self):
+        """Открывает TLS-соединение с OpenRouter заранее, чтобы первый запрос не ждал рукопожатия."""
+        if self.http_client is None:
+            return
+        started = time.monotonic()
+        try:
+            await self.http_client.head(OPENROUTER_BASE_URL, timeout=request_timeout(5.0, self.connect_timeout))
+            logger.info(f"Соединение с OpenRouter прогрето за {(time.monotonic() - started) * 1000:.0f} мс")
+        except Exception as e:
+            logger.warning("Не удалось прогреть соединение с OpenRouter: %s", e)
+
+    def start_keep_warm(self, interval: float = LLM_WARM_INTERVAL):
+        """Прогрев сразу и затем после каждых interval секунд простоя (keep-alive пул иначе закроет соединение)."""
+        if self._warm_task is None or self._warm_task.done():
+            self._warm_task = asyncio.create_task(self._keep_warm_loop(interval))
+
+    async def _keep_warm_loop(self, interval: float):
+        await self.warm_up()
+        while interval > 0:
+            await asyncio.sleep(interval)
+            if time.monotonic() - self._last_request_at >= interval:
+                await self.warm_up()
+
+    async def close(self):
+        if self._warm_task and not self._warm_task.done():
+            self._warm_task.cancel()
+        if self.http_client is not None:
+            await self.http_client.aclose()
 
     def _get_model_id(self, provider: str) -> str:
         return OPENROUTER_MODELS.get(provider) or OPENROUTER_MODELS["trinity"]
 
+    def token_budget(self, provider: str) -> int:
+        """Бюджет токенов запроса для провайдера (короткое имя, как в OPENROUTER_MODELS)."""
+        return self.token_budgets.get(provider, self.default_token_budget)
+
+    def _model_available(self, model: str) -> bool:
+        return self.breakers is None or self.breakers.for_model(model).allows_request
+
+    def _auto_chain(self) -> List[str]:
+        """Модели уровня auto_tier от лучшей к худшей, затем общие резервы."""
+        tier = [self._get_model_id(p) for p in MODEL_TIERS[self.auto_tier]]
+        chain = self.model_stats.rank(tier, self._model_available)
+        # Пока ответ не пришёл, следующий запрос не должен считать эту модель давно не использованной
+        self.model_stats.for_model(chain[0]).last_used = time.monotonic()
+        for candidate in self.default_fallback:
+            model = self._get_model_id(candidate)
+            if model not in chain:
+                chain.append(model)
+        return chain
+
+    def _model_chain(self, model: str) -> List[str]:
+        """Основная модель и её резервы по порядку, без повторов."""
+        fallbacks = self.fallback_chains.get(model)
+        if fallbacks is None:
+            fallbacks = [self._get_model_id(p) for p in self.default_fallback]
+        chain = [model]
+        for candidate in fallbacks:
+            if candidate not in chain:
+                chain.append(candidate)
+        return chain
+
+    async def _complete_with_fallback(
+        self,
+        model: str,
+        messages: List[Dict[str, Any]],
+        temperature: float,
+        on_delta: Optional[DeltaCallback] = None,
+        chain: Optional[List[str]] = None,
+    ) -> str:
+        """
+        _complete по цепочке моделей: при недоступности модели запрос уходит следующей.
+
+        Если hedge_delay > 0 и основная модель не прислала первый фрагмент потока за hedge_delay
+        секунд, параллельно запускается следующая модель цепочки. Побеждает первый фрагмент,
+        проигравший запрос отменяется. Запросы без потока не дублируются: по ним не видно первого
+        байта, а долгий полный ответ — не повод платить дважды. После начала вывода потока
+        переключение невозможно — ошибка поднимается как есть.
+        """
+        chain = chain or self._model_chain(model)
+        if len(chain) == 1:
+            return await self._complete(chain[0], messages, temperature, on_delta)
+
+        attempts: Dict[asyncio.Task, str] = {}
+        committed: Optional[asyncio.Task] = None
+        next_index = 0
+        last_error: Optional[BaseException] = None
+
+        def cancel_others(keep: Optional[asyncio.Task]):
+            for task in attempts:
+                if task is not keep:
+                    task.cancel()
+
+        def start_next():
+            nonlocal next_index
+            attempt_model = chain[next_index]
+            next_index += 1
+            holder: List[asyncio.Task] = []
+
+            async def forward(delta: str):
+                nonlocal committed
+                if committed is None:
+                    committed = holder[0]
+                    cancel_others(committed)
+                if committed is holder[0]:
+                    await on_delta(delta)
+
+            task = asyncio.create_task(
+                self._complete(attempt_model, messages, temperature, forward if on_delta else None)
+            )
+            holder.append(task)
+            attempts[task] = attempt_model
+
+        start_next()
+        try:
+            while attempts:
+                can_hedge = (
+                    self.hedge_delay > 0 and on_delta is not None and committed is None
+                    and len(attempts) == 1 and next_index < len(chain)
+                )
+                done, _ = await asyncio.wait(
+                    attempts, timeout=self.hedge_delay if can_hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    self.hedged_requests += 1
+                    logger.info(
+                        f"{chain[next_index - 1]} не начала ответ за {self.hedge_delay:g} с, "
+                        f"параллельно запрашиваю {chain[next_index]}"
+                    )
+                    start_next()
+                    continue
+                for task in done:
+                    attempt_model = attempts.pop(task)
+                    if task.cancelled():
+                        continue
+                    error = task.exception()
+                    if error is None:
+                        cancel_others(task)
+                        if attempt_model != chain[0]:
+                            logger.info(f"Ответ получен от резервной модели {attempt_model} вместо {chain[0]}")
+                        return task.result()
+                    last_error = error
+                    if committed is task or not _should_fall_back(error):
+                        raise error
+                    logger.warning(f"Модель {attempt_model} недоступна: {error}")
+                if not attempts and next_index < len(chain):
+                    self.fallback_requests += 1
+                    logger.info(f"Переключаюсь на резервную модель {chain[next_index]}")
+                    start_next()
+            raise last_error or Exception("Пустой ответ от OpenRouter")
+        finally:
+            cancel_others(None)
+            if attempts:
+                await asyncio.gather(*attempts, return_exceptions=True)
+
+    async def _complete(
+        self,
+        model: str,
+        messages: List[Dict[str, Any]],
+        temperature: float,
+        on_delta: Optional[DeltaCallback] = None,
+    ) -> str:
+        """
+        Один запрос к OpenRouter в пределах лимитов модели. С on_delta ответ читается потоком (stream=True).
+
+        Отключённая автоматом модель отклоняется сразу (CircuitOpenError), не занимая очередь.
+        """
+        breaker = self.breakers.for_model(model) if self.breakers else None
+        if breaker:
+            breaker.before_request()
+        stats = self.model_stats.for_model(model)
+        started = time.monotonic()
+        try:
+            result = await self._limited_request(model, messages, temperature, on_delta)
+        except BaseException as e:
+            if _counts_against_model(e):
+                stats.record_failure()
+                if breaker:
+                    breaker.record_failure()
+            elif breaker:
+                breaker.release()
+            raise
+        stats.record_success(time.monotonic() - started)
+        if breaker:
+            breaker.record_success()
+        return result
+
+    async def _limited_request(
+        self,
+        model: str,
+        messages: List[Dict[str, Any]],
+        temperature: float,
+        on_delta: Optional[DeltaCallback] = None,
+    ) -> str:
+        if self.rate_limiter is None:
+            return await self._request(model, messages, temperature, on_delta)
+        async with self.rate_limiter.for_model(model).slot():
+            return await self._request(model, messages, temperature, on_delta)
+
+    async def _request(
+        self,
+        model: str,
+        messages: List[Dict[str, Any]],
+        temperature: float,
+        on_delta: Optional[DeltaCallback] = None,
+    ) -> str:
+        if model == AUTO_MODEL:
+            raise ValueError("Модель auto должна быть заменена конкретной моделью до запроса")
+        self._last_request_at = time.monotonic()
+        messages = _prepare_messages(model, messages)
+        if on_delta is None:
+            response = await self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                timeout=request_timeout(self.read_timeout, self.connect_timeout),
+            )
+            self._record_usage(model, getattr(response, "usage", None))
+            if response.choices and response.choices[0].message.content:
+                return response.choices[0].message.content.strip()
+            raise Exception("Пустой ответ от OpenRouter")
+
+        stream = await self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True},
+            timeout=request_timeout(self.stream_read_timeout, self.connect_timeout),
+        )
+        parts: List[str] = []
+        try:
+            async for chunk in stream:
+                # usage приходит последним фрагментом, без choices
+                if getattr(chunk, "usage", None) is not None:
+                    self._record_usage(model, chunk.usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    await on_delta(delta)
+        finally:
+            await stream.close()
+        text = "".join(parts).strip()
+        if not text:
+            raise Exception("Пустой ответ от OpenRouter")
+        return text
+
+    def _record_usage(self, model: str, usage: Any):
+        prompt_tokens, cached_tokens, completion_tokens = _usage_counts(usage)
+        if not prompt_tokens:
+            return
+        self.model_stats.for_model(model).record_usage(prompt_tokens, cached_tokens, completion_tokens)
+        logger.info(
+            f"{model}: {prompt_tokens} токенов запроса (из кэша провайдера {cached_tokens}), "
+            f"{completion_tokens} токенов ответа"
+        )
+
+    def get_rate_limit_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Очередь, число запросов в работе и время ожидания по каждой модели."""
+        return self.rate_limiter.stats() if self.rate_limiter else {}
+
+    def get_model_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Задержка (EWMA, p50, p95) и доля ошибок по моделям — по ним выбирает auto."""
+        return self.model_stats.stats()
+
+    def get_breaker_stats(self) -> Dict[str, Dict[str, Any]]:
+        return self.breakers.stats() if self.breakers else {}
+
+    @staticmethod
+    def _fingerprint(model: str, messages: List[Dict[str, Any]], temperature: float) -> str:
+        payload = json.dumps([model, messages, round(float(temperature), 3)], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def _complete_shared(
+        self,
+        model: str,
+        messages: List[Dict[str, Any]],
+        temperature: float,
+        on_delta: Optional[DeltaCallback] = None,
+        chain: Optional[List[str]] = None,
+    ) -> str:
+        """
+        _complete_with_fallback с объединением одинаковых одновременных запросов (single-flight).
+
+        Все вызовы с тем же (model, messages, temperature) ждут одну задачу. Подключившийся позже
+        сначала получает уже пришедший текст, затем остальной поток; если запрос шёл без потока,
+        on_delta получает готовый ответ одним фрагментом. Ошибка запроса поднимается у каждого
+        ожидающего; отмена одного ожидающего не трогает остальных, а запрос отменяется, только
+        когда его больше никто не ждёт.
+        """
+        if not self.coalesce_enabled:
+            return await self._complete_with_fallback(model, messages, temperature, on_delta, chain)
+
+        key = self._fingerprint(model, messages, temperature)
+        flight = self._in_flight.get(key)
+        if flight is None:
+            flight = _InFlight()
+            flight.task = asyncio.create_task(
+                self._complete_with_fallback(
+                    model, messages, temperature, flight.fanout if on_delta else None, chain
+                )
+            )
+            self._in_flight[key] = flight
+            flight.task.add_done_callback(
+                lambda _t, k=key, f=flight: self._in_flight.pop(k) if self._in_flight.get(k) is f else None
+            )
+        else:
+            self.coalesced_requests += 1
+            logger.info(f"Запрос к {model} объединён с уже выполняющимся ({flight.waiters} ожидающих)")
+
+        subscriber = _Subscriber(on_delta)
+        flight.waiters += 1
+        try:
+            if on_delta is not None:
+                # Без await между снимком и подпиской: ни один фрагмент не потеряется и не задвоится
+                async with subscriber.lock:
+                    snapshot = "".join(flight.parts)
+                    flight.subscribers.append(subscriber)
+                    if snapshot:
+                        try:
+                            await on_delta(snapshot)
+                            subscriber.delivered = True
+                        except Exception as e:
+                            subscriber.failed = True
+                            logger.warning("Колбэк потока отключён после ошибки: %s", e)
+            result = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                if self._in_flight.get(key) is flight:
+                    del self._in_flight[key]
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+            if subscriber in flight.subscribers:
+                flight.subscribers.remove(subscriber)
+        if on_delta is not None and not subscriber.delivered and not subscriber.failed:
+            await on_delta(result)
+        return result
+
     async def optimize_prompt(
         self,
         user_prompt: str,
@@ -39,27 +622,47 @@ class LLMService:
         context_prompt: Optional[str] = None,
         provider: str = "trinity",
         temperature: float = 0.4,
+        on_delta: Optional[DeltaCallback] = None,
+        user_context: Optional[str] = None,
     ) -> str:
+        """
+        Улучшает промпт в простом режиме.
+
+        Запрос собран так, чтобы статичная часть (context_prompt и meta_prompt) шла общим префиксом
+        для всех пользователей с одинаковыми настройками: user_context (предпочтения пользователя)
+        и сам промпт идут после неё.
+        """
         if not self.client:
             raise ValueError("LLM сервис не инициализирован")
         model = self._get_model_id(provider)
-        full_prompt = f"{meta_prompt}\n\nПромпт для оптимизации:\n{user_prompt}"
         messages = []
         if context_prompt:
-            messages.append({"role": "system", "content": context_prompt})
-        messages.append({"role": "user", "content": full_prompt})
+            messages.append({"role": "system", "content": [_cached_part(context_prompt)]})
+        user_parts = [_cached_part(meta_prompt)]
+        if user_context:
+            user_parts.append({"type": "text", "text": f"\n\n{user_context}"})
+        user_parts.append({"type": "text", "text": f"\n\nПромпт для оптимизации:\n{user_prompt}"})
+        messages.append({"role": "user", "content": user_parts})
+        logger.info(f"Запрос к {provider}: ~{estimate_messages_tokens(messages)} токенов")
+
+        cache_key = None
+        if self.cache is not None and self.cache.accepts(temperature):
+            cache_context = f"{user_context}\n\n{context_prompt or ''}" if user_context else context_prompt
+            cache_key = self.cache.make_key(model, meta_prompt, cache_context, user_prompt, temperature)
+            cached = await self.cache.get(cache_key)
+            if cached is not None:
+                if on_delta is not None:
+                    await on_delta(cached)
+                return cached
         try:
-            response = await self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-            )
-            if response.choices and response.choices[0].message.content:
-                return response.choices[0].message.content.strip()
-            raise Exception("Пустой ответ от OpenRouter")
+            chain = self._auto_chain() if provider == AUTO_PROVIDER else None
+            result = await self._complete_shared(model, messages, temperature, on_delta, chain)
         except Exception as e:
             logger.error(f"Ошибка OpenRouter: {e}")
             raise
+        if cache_key is not None:
+            await self.cache.set(cache_key, model, result)
+        return result
 
     async def chat_with_history(
         self,
@@ -68,23 +671,39 @@ class LLMService:
         system_prompt: str,
         provider: str = "trinity",
         temperature: float = 0.4,
+        on_delta: Optional[DeltaCallback] = None,
+        user_context: Optional[str] = None,
     ) -> str:
+        """
+        Запрос агента с историей диалога.
+
+        system_prompt должен быть статичным — он идёт первым и кэшируется провайдером как общий
+        префикс. Всё, что зависит от пользователя (user_context, краткое содержание, история),
+        идёт после него отдельными сообщениями.
+        """
         if not self.client:
             raise ValueError("LLM сервис не инициализирован")
         model = self._get_model_id(provider)
-        messages = [{"role": "system", "content": system_prompt}]
-        for msg in history:
+        system_messages = [{"role": "system", "content": [_cached_part(system_prompt)]}]
+        if user_context:
+            system_messages.append({"role": "system", "content": user_context})
+        user_message = {"role": "user", "content": user_content}
+        # system-сообщения истории (краткое содержание начала диалога) не обрезаются
+        pinned = [m for m in history if m["role"] == "system"]
+        dialog = [m for m in history if m["role"] != "system"]
+        fixed_tokens = estimate_messages_tokens([*system_messages, *pinned, user_message])
+        kept = trim_to_budget(dialog, self.token_budget(provider) - fixed_tokens)
+        messages = list(system_messages)
+        for msg in pinned + kept:
             messages.append({"role": msg["role"], "content": msg["content"]})
-        messages.append({"role": "user", "content": user_content})
+        messages.append(user_message)
+        logger.info(
+            f"Запрос к {provider}: ~{estimate_messages_tokens(messages)} токенов "
+            f"(история {len(kept)} из {len(dialog)} сообщений)"
+        )
         try:
-            response = await self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-            )
-            if response.choices and response.choices[0].message.content:
-                return response.choices[0].message.content.strip()
-            raise Exception("Пустой ответ от OpenRouter")
+            chain = self._auto_chain() if provider == AUTO_PROVIDER else None
+            return await self._complete_shared(model, messages, temperature, on_delta, chain)
         except Exception as e:
             logger.error(f"Ошибка OpenRouter: {e}")
             raise
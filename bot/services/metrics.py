@@ -0,0 +1,157 @@
+import asyncio
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional, Tuple
+
+from bot.services.rouge import TOKENIZER_COMPAT, TOKENIZER_UNICODE, rouge_1_2
+
+logger = logging.getLogger(__name__)
+
+# Подсчёт метрик уходит в пул, чтобы длинный промпт не блокировал event loop для остальных чатов
+METRICS_EXECUTOR = "thread"  # "thread" | "process"
+METRICS_MAX_WORKERS = 2
+METRICS_TIMEOUT = 2.0
+
+# "native" — встроенный подсчёт n-грамм, "rouge_score" — библиотека (опционально, для сверки)
+ROUGE_BACKEND = "native"
+# "compat" даёт те же числа, что rouge_score (учитывает только латиницу и цифры), "unicode" — и кириллицу
+ROUGE_TOKENIZER = TOKENIZER_COMPAT
+
+STRUCTURE_MARKERS = (
+    "ты —", "ты -", "твоя задача", "задача:", "формат:", "шаги:", "ограничения:",
+    "ответь в формате", "выведи", "1.", "2.", "3.", "• ", "- ", "— "
+)
+
+
+@dataclass(frozen=True)
+class ReplyMetrics:
+    """Метрики «исходный → новый промпт», считаются за один проход и переиспользуются всеми строками ответа."""
+    original_len: int
+    new_len: int
+    original_words: int
+    new_words: int
+    struct_original: int
+    struct_new: int
+    rouge1: Optional[float]
+    rouge2: Optional[float]
+
+
+_rouge_backend = ROUGE_BACKEND
+_rouge_tokenizer = ROUGE_TOKENIZER
+
+
+def configure_rouge(backend: str = ROUGE_BACKEND, tokenizer: str = ROUGE_TOKENIZER):
+    global _rouge_backend, _rouge_tokenizer
+    if backend not in ("native", "rouge_score"):
+        raise ValueError(f"Неизвестный ROUGE backend: {backend}")
+    if tokenizer not in (TOKENIZER_COMPAT, TOKENIZER_UNICODE):
+        raise ValueError(f"Неизвестный ROUGE tokenizer: {tokenizer}")
+    _rouge_backend = backend
+    _rouge_tokenizer = tokenizer
+    # Процессы пула получают настройки через initializer при создании — пересоздаём пул
+    shutdown_metrics_executor()
+
+
+@lru_cache(maxsize=1)
+def _get_rouge_scorer():
+    """RougeScorer создаётся один раз на процесс: импорт и сборка токенизатора недешёвые."""
+    from rouge_score import rouge_scorer
+    return rouge_scorer.RougeScorer(["rouge1", "rouge2"], use_stemmer=False)
+
+
+def rouge_scores(reference: str, candidate: str) -> Optional[Tuple[float, float]]:
+    """Возвращает (R-1 F1, R-2 F1) или None при ошибке/пустых текстах."""
+    if not reference.strip() or not candidate.strip():
+        return None
+    try:
+        if _rouge_backend == "native":
+            return rouge_1_2(reference, candidate, _rouge_tokenizer)
+        scores = _get_rouge_scorer().score(reference, candidate)
+        return scores["rouge1"].fmeasure, scores["rouge2"].fmeasure
+    except Exception as e:
+        logger.debug("ROUGE не посчитан: %s", e)
+        return None
+
+
+def count_structure_markers(text: str) -> int:
+    """Число типичных структурных элементов промпта (роль, задача, формат и т.д.)."""
+    if not text or not text.strip():
+        return 0
+    lower = text.lower()
+    return sum(1 for m in STRUCTURE_MARKERS if m in lower)
+
+
+def compute_reply_metrics(original: str, new_prompt: str) -> ReplyMetrics:
+    scores = rouge_scores(original, new_prompt)
+    return ReplyMetrics(
+        original_len=len(original),
+        new_len=len(new_prompt),
+        original_words=len(original.split()),
+        new_words=len(new_prompt.split()),
+        struct_original=count_structure_markers(original),
+        struct_new=count_structure_markers(new_prompt),
+        rouge1=scores[0] if scores else None,
+        rouge2=scores[1] if scores else None,
+    )
+
+
+_executor: Optional[Executor] = None
+_executor_kind = METRICS_EXECUTOR
+_max_workers = METRICS_MAX_WORKERS
+_timeout = METRICS_TIMEOUT
+
+
+def configure_metrics_executor(
+    kind: str = METRICS_EXECUTOR,
+    max_workers: int = METRICS_MAX_WORKERS,
+    timeout: float = METRICS_TIMEOUT,
+):
+    """Задаёт тип пула (thread/process), его размер и бюджет времени на подсчёт метрик."""
+    global _executor_kind, _max_workers, _timeout
+    if kind not in ("thread", "process"):
+        raise ValueError(f"Неизвестный тип пула метрик: {kind}")
+    shutdown_metrics_executor()
+    _executor_kind = kind
+    _max_workers = max(1, max_workers)
+    _timeout = timeout
+
+
+def _get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        if _executor_kind == "process":
+            # Настройки ROUGE передаются явно: при spawn глобальные переменные родителя не копируются
+            _executor = ProcessPoolExecutor(
+                max_workers=_max_workers,
+                initializer=configure_rouge,
+                initargs=(_rouge_backend, _rouge_tokenizer),
+            )
+        else:
+            _executor = ThreadPoolExecutor(max_workers=_max_workers, thread_name_prefix="metrics")
+    return _executor
+
+
+def shutdown_metrics_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def compute_reply_metrics_async(original: str, new_prompt: str) -> Optional[ReplyMetrics]:
+    """compute_reply_metrics в пуле; None, если не уложились в бюджет (ожидание в очереди пула тоже считается)."""
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(_get_executor(), compute_reply_metrics, original, new_prompt)
+    try:
+        return await asyncio.wait_for(future, _timeout)
+    except asyncio.TimeoutError:
+        logger.warning(
+            "Метрики не посчитаны за %.1f с (%d / %d симв.), строка метрик пропущена",
+            _timeout, len(original), len(new_prompt),
+        )
+        return None
+    except Exception as e:
+        logger.warning("Ошибка подсчёта метрик: %s", e)
+        return None
@@ -0,0 +1,132 @@
+import random
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional
+
+# Окно последних запросов для перцентилей и доли ошибок
+MODEL_STATS_WINDOW = 50
+# Вес нового замера в EWMA задержки
+MODEL_STATS_ALPHA = 0.2
+# Пока у модели меньше замеров, она считается неизученной и получает запросы в первую очередь
+MODEL_STATS_MIN_SAMPLES = 3
+# Доля запросов auto, уходящих случайной модели уровня, чтобы статистика не устаревала
+AUTO_EXPLORE_RATE = 0.05
+# Ошибка весит как столько-то раз увеличенная задержка: 20% ошибок ≈ вдвое медленнее
+ERROR_PENALTY = 5.0
+
+
+class ModelStats:
+    """Скользящая статистика одной модели: EWMA и перцентили задержки, доля ошибок."""
+
+    def __init__(self, window: int = MODEL_STATS_WINDOW, alpha: float = MODEL_STATS_ALPHA):
+        self.alpha = alpha
+        self.ewma: Optional[float] = None
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self._outcomes: Deque[bool] = deque(maxlen=window)
+        self.last_used = 0.0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+
+    def record_usage(self, prompt_tokens: int, cached_tokens: int, completion_tokens: int):
+        self.prompt_tokens += prompt_tokens
+        self.cached_tokens += cached_tokens
+        self.completion_tokens += completion_tokens
+
+    def record_success(self, latency: float):
+        self.ewma = latency if self.ewma is None else self.alpha * latency + (1 - self.alpha) * self.ewma
+        self._latencies.append(latency)
+        self._outcomes.append(True)
+        self.last_used = time.monotonic()
+
+    def record_failure(self):
+        self._outcomes.append(False)
+        self.last_used = time.monotonic()
+
+    @property
+    def samples(self) -> int:
+        return len(self._outcomes)
+
+    @property
+    def error_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def score(self) -> float:
+        """Чем меньше, тем лучше. Модель без успешных ответов — хуже любой отвечавшей."""
+        if self.ewma is None:
+            return float("inf")
+        p95 = self.percentile(0.95) or self.ewma
+        return (self.ewma + p95) / 2 * (1 + ERROR_PENALTY * self.error_rate)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "samples": self.samples,
+            "ewma": self.ewma,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "error_rate": self.error_rate,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_share": (self.cached_tokens / self.prompt_tokens) if self.prompt_tokens else 0.0,
+        }
+
+
+class ModelStatsRegistry:
+    """Статистика по id модели и выбор лучшей модели из списка кандидатов."""
+
+    def __init__(
+        self,
+        window: int = MODEL_STATS_WINDOW,
+        alpha: float = MODEL_STATS_ALPHA,
+        min_samples: int = MODEL_STATS_MIN_SAMPLES,
+        explore_rate: float = AUTO_EXPLORE_RATE,
+    ):
+        self.window = window
+        self.alpha = alpha
+        self.min_samples = min_samples
+        self.explore_rate = explore_rate
+        self._models: Dict[str, ModelStats] = {}
+
+    def for_model(self, model: str) -> ModelStats:
+        stats = self._models.get(model)
+        if stats is None:
+            stats = ModelStats(self.window, self.alpha)
+            self._models[model] = stats
+        return stats
+
+    def rank(self, models: Iterable[str], is_available: Callable[[str], bool] = lambda m: True) -> List[str]:
+        """
+        Кандидаты от лучшего к худшему; недоступные (открытый автомат) — в конце.
+
+        Неизученные модели идут первыми (давно не использовавшаяся — раньше), иногда первой
+        ставится случайная доступная модель — так оценки остальных тоже обновляются.
+        """
+        models = list(dict.fromkeys(models))
+        available = [m for m in models if is_available(m)]
+        unavailable = [m for m in models if m not in available]
+        unexplored = sorted(
+            (m for m in available if self.for_model(m).samples < self.min_samples),
+            key=lambda m: self.for_model(m).last_used,
+        )
+        explored = sorted(
+            (m for m in available if m not in unexplored),
+            key=lambda m: self.for_model(m).score(),
+        )
+        ordered = unexplored + explored
+        if len(ordered) > 1 and not unexplored and random.random() < self.explore_rate:
+            pick = random.choice(ordered[1:])
+            ordered.remove(pick)
+            ordered.insert(0, pick)
+        return ordered + unavailable
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {model: stats.stats() for model, stats in self._models.items()}
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# Лимиты на модель по умолчанию. Бесплатные модели OpenRouter (суффикс ":free") режутся
+# примерно на 20 запросах в минуту, поэтому для них держим запас.
+LLM_MAX_CONCURRENT = 8
+LLM_REQUESTS_PER_MINUTE = 120
+LLM_FREE_MAX_CONCURRENT = 2
+LLM_FREE_REQUESTS_PER_MINUTE = 16
+LLM_QUEUE_TIMEOUT = 30.0
+# Ожидание в очереди дольше этого порога пишется в лог
+SLOW_QUEUE_WAIT = 1.0
+
+
+class LLMQueueTimeoutError(Exception):
+    """Запрос не дождался свободного слота модели за queue_timeout."""
+
+
+class ModelLimits(NamedTuple):
+    max_concurrent: int
+    requests_per_minute: float
+
+
+def parse_model_limits(spec: str) -> Dict[str, ModelLimits]:
+    """Разбирает строку вида "trinity=2:16,qwen3=4:60" (модель=одновременно:в_минуту)."""
+    limits: Dict[str, ModelLimits] = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, value = item.partition("=")
+        concurrent, _, rpm = value.partition(":")
+        try:
+            limits[name.strip()] = ModelLimits(int(concurrent), float(rpm or 0))
+        except ValueError:
+            raise ValueError(f"Неверный лимит модели: {item!r} (ожидается модель=N:RPM)")
+    return limits
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity про запас. Ожидающие идут по очереди."""
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ModelLimiter:
+    """Ограничение одной модели: не больше max_concurrent запросов сразу и requests_per_minute в минуту."""
+
+    def __init__(self, name: str, limits: ModelLimits, queue_timeout: float = LLM_QUEUE_TIMEOUT):
+        self.name = name
+        self.limits = limits
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(max(1, limits.max_concurrent))
+        self._bucket = TokenBucket(limits.requests_per_minute / 60.0, capacity=limits.max_concurrent)
+        self.queued = 0
+        self.in_flight = 0
+        self.requests = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def _acquire(self):
+        await self._semaphore.acquire()
+        try:
+            await self._bucket.acquire()
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        started = time.monotonic()
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self._acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise LLMQueueTimeoutError(
+                f"Модель {self.name} перегружена: нет свободного слота за {self.queue_timeout:g} с"
+            )
+        finally:
+            self.queued -= 1
+        waited = time.monotonic() - started
+        self.requests += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        if waited >= SLOW_QUEUE_WAIT:
+            logger.info(f"Очередь к {self.name}: ожидание {waited:.1f} с, ещё в очереди {self.queued}")
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrent": self.limits.max_concurrent,
+            "requests_per_minute": self.limits.requests_per_minute,
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "timeouts": self.timeouts,
+            "avg_wait": (self.wait_total / self.requests) if self.requests else 0.0,
+            "max_wait": self.wait_max,
+        }
+
+
+class RateLimiter:
+    """Набор ModelLimiter по id модели; лимиты берутся из overrides, иначе по умолчанию (отдельно для :free)."""
+
+    def __init__(
+        self,
+        default: ModelLimits = ModelLimits(LLM_MAX_CONCURRENT, LLM_REQUESTS_PER_MINUTE),
+        free: ModelLimits = ModelLimits(LLM_FREE_MAX_CONCURRENT, LLM_FREE_REQUESTS_PER_MINUTE),
+        overrides: Optional[Dict[str, ModelLimits]] = None,
+        queue_timeout: float = LLM_QUEUE_TIMEOUT,
+    ):
+        self.default = default
+        self.free = free
+        self.overrides = overrides or {}
+        self.queue_timeout = queue_timeout
+        self._limiters: Dict[str, ModelLimiter] = {}
+
+    def for_model(self, model: str) -> ModelLimiter:
+        limiter = self._limiters.get(model)
+        if limiter is None:
+            limits = self.overrides.get(model) or (self.free if model.endswith(":free") else self.default)
+            limiter = ModelLimiter(model, limits, self.queue_timeout)
+            self._limiters[model] = limiter
+        return limiter
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {model: limiter.stats() for model, limiter in self._limiters.items()}
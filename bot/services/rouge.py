@@ -0,0 +1,52 @@
+"""ROUGE-1/ROUGE-2 (F-мера, без стемминга) без зависимости от rouge-score.
+
+Режим токенизации "compat" повторяет rouge_score.tokenize (нижний регистр, только [a-z0-9]),
+поэтому числа совпадают с библиотекой. Режим "unicode" учитывает кириллицу и любые буквы/цифры.
+"""
+import re
+from collections import Counter
+from typing import List, Sequence, Tuple
+
+TOKENIZER_COMPAT = "compat"
+TOKENIZER_UNICODE = "unicode"
+
+_NON_ALNUM_ASCII = re.compile(r"[^a-z0-9]+")
+_UNICODE_TOKEN = re.compile(r"[^\W_]+")
+
+NgramCounts = Tuple[Counter, Counter]
+
+
+def tokenize(text: str, mode: str = TOKENIZER_COMPAT) -> List[str]:
+    lowered = text.lower()
+    if mode == TOKENIZER_UNICODE:
+        return _UNICODE_TOKEN.findall(lowered)
+    return _NON_ALNUM_ASCII.sub(" ", lowered).split()
+
+
+def ngram_counts(tokens: Sequence[str]) -> NgramCounts:
+    """Счётчики униграмм и биграмм."""
+    return Counter(tokens), Counter(zip(tokens, tokens[1:]))
+
+
+def _fmeasure(reference: Counter, candidate: Counter) -> float:
+    # Пересечение мультимножеств: сумма min(count) по общим n-граммам, обход по меньшему счётчику
+    small, large = (reference, candidate) if len(reference) <= len(candidate) else (candidate, reference)
+    overlap = sum(min(n, large[g]) for g, n in small.items() if g in large)
+    precision = overlap / max(sum(candidate.values()), 1)
+    recall = overlap / max(sum(reference.values()), 1)
+    if precision + recall > 0:
+        return 2 * precision * recall / (precision + recall)
+    return 0.0
+
+
+def _scores_from_counts(reference: NgramCounts, candidate: NgramCounts) -> Tuple[float, float]:
+    return _fmeasure(reference[0], candidate[0]), _fmeasure(reference[1], candidate[1])
+
+
+def rouge_1_2(reference: str, candidate: str, mode: str = TOKENIZER_COMPAT) -> Tuple[float, float]:
+    """(R-1 F1, R-2 F1) для пары текстов."""
+    return _scores_from_counts(
+        ngram_counts(tokenize(reference, mode)),
+        ngram_counts(tokenize(candidate, mode)),
+    )
+
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional, Union
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from bot.services.rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота, ~1 в секунду в личный чат (короткие всплески
+# допустимы) и ~20 в минуту в группу
+TG_GLOBAL_RATE = 30.0
+TG_CHAT_RATE = 1.0
+TG_CHAT_BURST = 5
+TG_GROUP_RATE = 20 / 60
+# Сколько раз повторять запрос после TelegramRetryAfter
+TG_MAX_RETRIES = 3
+# Состояние чата, из которого давно ничего не отправляли, забывается
+TG_CHAT_IDLE_TTL = 300.0
+# Лимит чата и очередь по порядку — только для новых сообщений. Правки и удаления (нажатие на
+# вариант ответа, превью при стриминге) не тратят всплеск, нужный вопросам, и не ждут его
+_NEW_MESSAGE_PREFIXES = ("Send", "Forward", "Copy")
+_NOT_NEW_MESSAGES = ("SendChatAction",)
+
+_background: ContextVar[bool] = ContextVar("telegram_background_send", default=False)
+
+
+@contextmanager
+def background_sends() -> Iterator[None]:
+    """Запросы к Telegram внутри блока — фоновые: уступают интерактивным и не повторяются после RetryAfter."""
+    token = _background.set(True)
+    try:
+        yield
+    finally:
+        _background.reset(token)
+
+
+class _ChatQueue:
+    __slots__ = ("lock", "bucket", "users", "last_used")
+
+    def __init__(self, rate: float, burst: float):
+        self.lock = asyncio.Lock()
+        self.bucket = TokenBucket(rate, capacity=burst)
+        self.users = 0
+        self.last_used = time.monotonic()
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: запросы с chat_id проходят через общую корзину токенов, новые
+    сообщения — ещё и через корзину чата.
+
+    Новые сообщения в один чат отправляются строго по очереди (порядок сохраняется), в том числе
+    при ожидании после TelegramRetryAfter; правки и удаления в эту очередь не встают.
+    Интерактивные запросы получают общий токен раньше фоновых (см. background_sends). Запросы
+    без chat_id (answerCallbackQuery, getUpdates) не ограничиваются.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = TG_GLOBAL_RATE,
+        chat_rate: float = TG_CHAT_RATE,
+        chat_burst: int = TG_CHAT_BURST,
+        group_rate: float = TG_GROUP_RATE,
+        max_retries: int = TG_MAX_RETRIES,
+    ):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, capacity=global_rate)
+        # Фоновые запросы заходят в общую очередь по одному и только когда нет интерактивных
+        self._background_lock = asyncio.Lock()
+        self._interactive_waiting = 0
+        self._interactive_idle = asyncio.Event()
+        self._interactive_idle.set()
+        self._chats: Dict[Union[int, str], _ChatQueue] = {}
+        self.requests = 0
+        self.retries = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        background = _background.get()
+        name = type(method).__name__
+        if not name.startswith(_NEW_MESSAGE_PREFIXES) or name in _NOT_NEW_MESSAGES:
+            return await self._send(make_request, bot, method, chat_id, background, None)
+        chat = self._chat(chat_id)
+        chat.users += 1
+        try:
+            async with chat.lock:
+                return await self._send(make_request, bot, method, chat_id, background, chat)
+        finally:
+            chat.users -= 1
+            chat.last_used = time.monotonic()
+
+    async def _send(self, make_request, bot, method, chat_id, background: bool, chat: Optional[_ChatQueue]):
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            if chat is not None:
+                await chat.bucket.acquire()
+            await self._acquire_global(background)
+            self._record_wait(time.monotonic() - started)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if background or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.retries += 1
+                logger.warning(
+                    f"Telegram: flood control в чате {chat_id} ({type(method).__name__}), "
+                    f"повтор через {e.retry_after} с"
+                )
+                await asyncio.sleep(e.retry_after)
+
+    def _chat(self, chat_id: Union[int, str]) -> _ChatQueue:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            self._forget_idle_chats()
+            is_group = not isinstance(chat_id, int) or chat_id < 0
+            chat = _ChatQueue(self.group_rate if is_group else self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = chat
+        return chat
+
+    def _forget_idle_chats(self):
+        # Корзина простаивающего чата к этому времени всё равно полная
+        deadline = time.monotonic() - TG_CHAT_IDLE_TTL
+        for chat_id in [cid for cid, c in self._chats.items() if not c.users and c.last_used < deadline]:
+            del self._chats[chat_id]
+
+    async def _acquire_global(self, background: bool):
+        if not background:
+            self._interactive_waiting += 1
+            self._interactive_idle.clear()
+            try:
+                await self._global.acquire()
+            finally:
+                self._interactive_waiting -= 1
+                if not self._interactive_waiting:
+                    self._interactive_idle.set()
+            return
+        async with self._background_lock:
+            await self._interactive_idle.wait()
+            await self._global.acquire()
+
+    def _record_wait(self, waited: float):
+        self.requests += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "chats": len(self._chats),
+            "avg_wait": (self.wait_total / self.requests) if self.requests else 0.0,
+            "max_wait": self.wait_max,
+        }
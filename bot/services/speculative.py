@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, NamedTuple, Optional
+
+from bot.services.llm_client import LLMService
+
+logger = logging.getLogger(__name__)
+
+# Сколько держать заготовленный ответ, секунд: дольше пользователь вряд ли думает над вопросами
+SPECULATIVE_TTL = 900.0
+
+
+class _Speculation(NamedTuple):
+    task: asyncio.Task
+    request: Dict[str, Any]
+    started_at: float
+
+
+class SpeculativeReplies:
+    """
+    Заранее запущенные ответы модели, которые пользователь, скорее всего, запросит следующим.
+
+    start() запускает chat_with_history в фоне (не больше одной заготовки на пользователя),
+    take() отдаёт её результат, если запрос совпал с заготовленным, cancel() отменяет
+    заготовку — отменённый запрос сразу освобождает слот провайдера.
+    """
+
+    def __init__(self, llm_service: LLMService, ttl: float = SPECULATIVE_TTL):
+        self.llm_service = llm_service
+        self.ttl = ttl
+        self._pending: Dict[int, _Speculation] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def start(self, user_id: int, **request):
+        self.cancel(user_id)
+        task = asyncio.create_task(self.llm_service.chat_with_history(**request))
+        task.add_done_callback(self._log_failure)
+        self._pending[user_id] = _Speculation(task, request, time.monotonic())
+
+    async def take(self, user_id: int, **request) -> Optional[str]:
+        """Результат заготовки для такого же запроса (дождётся, если она ещё идёт) или None."""
+        speculation = self._pending.pop(user_id, None)
+        if speculation is None:
+            return None
+        if speculation.request != request or time.monotonic() - speculation.started_at > self.ttl:
+            speculation.task.cancel()
+            self.misses += 1
+            return None
+        try:
+            # shield: отмена вызывающего (ход вытеснен новым сообщением) не должна выглядеть
+            # как отменённая заготовка, иначе вызывающий пошёл бы за ответом к модели заново
+            reply = await asyncio.shield(speculation.task)
+        except asyncio.CancelledError:
+            current = asyncio.current_task()
+            if not speculation.task.cancelled() or (current is not None and current.cancelling()):
+                speculation.task.cancel()
+                raise
+            self.misses += 1
+            return None
+        except Exception:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return reply
+
+    def cancel(self, user_id: int):
+        speculation = self._pending.pop(user_id, None)
+        if speculation is not None and not speculation.task.done():
+            speculation.task.cancel()
+
+    @staticmethod
+    def _log_failure(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.info("Заготовка ответа не удалась: %s", task.exception())
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "pending": len(self._pending)}
+
+    async def close(self):
+        tasks = [s.task for s in self._pending.values() if not s.task.done()]
+        self._pending.clear()
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
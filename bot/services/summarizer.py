@@ -0,0 +1,98 @@
+import asyncio
+import logging
+from typing import Dict
+
+from bot.db.sqlite_manager import SQLiteManager
+from bot.services.llm_client import LLMService
+from bot.services.tokens import estimate_messages_tokens, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Сворачиваем, когда сохранённая история (с прошлым кратким содержанием) длиннее порога
+SUMMARY_TRIGGER_TOKENS = 2500
+# Столько последних сообщений всегда остаются дословно
+SUMMARY_KEEP_RECENT = 4
+SUMMARY_PROVIDER = "gemini"
+SUMMARY_TEMPERATURE = 0.2
+
+SUMMARY_HEADER = "Краткое содержание начала диалога с пользователем:\n"
+SUMMARY_SYSTEM_PROMPT = (
+    "Ты сжимаешь историю диалога ассистента, который помогает пользователю составлять промпты. "
+    "Сохрани: исходную задачу пользователя, его ответы на уточняющие вопросы, требования и правки, "
+    "принятые решения. Если в диалоге были готовые промпты — перескажи только суть последней версии "
+    "в 2–3 предложениях, не копируй промпт целиком. Пиши кратко, по пунктам, без вступлений."
+)
+
+
+class HistorySummarizer:
+    """
+    Фоновое сворачивание истории агента: старые сообщения заменяются кратким содержанием.
+
+    schedule() вызывается после сохранения очередного обмена и возвращается сразу; сжатие идёт
+    отдельной задачей (не больше одной на пользователя) и не задерживает ответ пользователю.
+    """
+
+    def __init__(
+        self,
+        db_manager: SQLiteManager,
+        llm_service: LLMService,
+        provider: str = SUMMARY_PROVIDER,
+        trigger_tokens: int = SUMMARY_TRIGGER_TOKENS,
+        keep_recent: int = SUMMARY_KEEP_RECENT,
+    ):
+        self.db_manager = db_manager
+        self.llm_service = llm_service
+        self.provider = provider
+        self.trigger_tokens = trigger_tokens
+        self.keep_recent = max(1, keep_recent)
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    def schedule(self, user_id: int):
+        task = self._tasks.get(user_id)
+        if task is not None and not task.done():
+            return
+        task = asyncio.create_task(self._summarize(user_id))
+        self._tasks[user_id] = task
+        task.add_done_callback(
+            lambda t, uid=user_id: self._tasks.pop(uid, None) if self._tasks.get(uid) is t else None
+        )
+
+    async def _summarize(self, user_id: int):
+        try:
+            rows = await self.db_manager.get_agent_history_rows(user_id)
+            previous = await self.db_manager.get_agent_summary(user_id) or ""
+            messages = [{"role": role, "content": content} for _, role, content in rows]
+            total = estimate_messages_tokens(messages) + estimate_tokens(previous)
+            old = rows[:-self.keep_recent]
+            if total < self.trigger_tokens or not old:
+                return
+            transcript = "\n\n".join(
+                f"{'Пользователь' if role == 'user' else 'Ассистент'}: {content}" for _, role, content in old
+            )
+            user_content = ""
+            if previous:
+                user_content += f"Прежнее краткое содержание:\n{previous.removeprefix(SUMMARY_HEADER)}\n\n"
+            user_content += f"Продолжение диалога, которое нужно добавить в краткое содержание:\n\n{transcript}"
+            summary = await self.llm_service.chat_with_history(
+                user_content=user_content,
+                history=[],
+                system_prompt=SUMMARY_SYSTEM_PROMPT,
+                provider=self.provider,
+                temperature=SUMMARY_TEMPERATURE,
+            )
+            saved = await self.db_manager.save_agent_summary(user_id, SUMMARY_HEADER + summary.strip(), old[-1][0])
+            if saved:
+                logger.info(
+                    f"История пользователя {user_id}: {len(old)} сообщений (~{total} токенов всего) "
+                    f"свёрнуты в ~{estimate_tokens(summary)} токенов"
+                )
+        except Exception as e:
+            logger.warning("Не удалось свернуть историю пользователя %s: %s", user_id, e)
+
+    async def close(self):
+        tasks = [t for t in self._tasks.values() if not t.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
@@ -0,0 +1,47 @@
+"""Быстрая оценка числа токенов без токенизатора модели.
+
+BPE-токенизаторы в среднем укладывают ~4 символа латиницы и ~2.5 символа кириллицы в токен;
+оценка не точная, но стабильная и дешёвая (без обхода строки в Python).
+"""
+import math
+from typing import Any, Dict, List, Sequence
+
+ASCII_CHARS_PER_TOKEN = 4.0
+OTHER_CHARS_PER_TOKEN = 2.5
+# Служебные токены на каждое сообщение чата (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    # Не-ASCII символы занимают в UTF-8 2+ байта: разница длин ≈ их число (для кириллицы точно)
+    other = min(len(text.encode("utf-8")) - len(text), len(text))
+    ascii_chars = len(text) - other
+    return math.ceil(ascii_chars / ASCII_CHARS_PER_TOKEN + other / OTHER_CHARS_PER_TOKEN)
+
+
+def estimate_message_tokens(message: Dict[str, Any]) -> int:
+    content = message.get("content", "")
+    if isinstance(content, list):
+        # Содержимое из частей (например, с cache_control) — считаем только текст
+        content = "".join(part.get("text", "") for part in content)
+    return estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+
+def estimate_messages_tokens(messages: Sequence[Dict[str, Any]]) -> int:
+    return sum(estimate_message_tokens(m) for m in messages)
+
+
+def trim_to_budget(history: Sequence[Dict[str, str]], budget: int) -> List[Dict[str, str]]:
+    """Самые новые сообщения истории, суммарно укладывающиеся в budget токенов (старые отбрасываются)."""
+    kept: List[Dict[str, str]] = []
+    used = 0
+    for message in reversed(history):
+        cost = estimate_message_tokens(message)
+        if used + cost > budget:
+            break
+        kept.append(message)
+        used += cost
+    kept.reverse()
+    return kept
@@ -0,0 +1,120 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# Пауза перед запросом к модели: сообщения, пришедшие за это время, склеиваются в один запрос
+USER_DEBOUNCE = 0.0
+
+
+class SupersededError(Exception):
+    """Запрос пользователя вытеснен более новым сообщением того же пользователя."""
+
+
+class UserTurn:
+    """Один ход пользователя: тексты сообщений, вошедших в него, и задача запроса к модели."""
+
+    __slots__ = ("texts", "task", "superseded", "finished")
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.task: Optional[asyncio.Task] = None
+        self.superseded = False
+        self.finished = False
+
+    @property
+    def text(self) -> str:
+        return "\n\n".join(self.texts)
+
+
+class UserTaskRegistry:
+    """
+    Текущий запрос к модели для каждого пользователя.
+
+    begin() открывает новый ход и отменяет незавершённый предыдущий: его тексты переходят
+    в новый ход, а отменённый запрос сразу освобождает слот провайдера (нажатие посторонней
+    кнопки ход с текстом не отменяет). run() выполняет запрос хода (после паузы debounce) и бросает
+    SupersededError, если ход вытеснен.
+    history_lock() упорядочивает запись истории одного пользователя.
+    """
+
+    def __init__(self, debounce: float = USER_DEBOUNCE):
+        self.debounce = debounce
+        self._turns: Dict[int, UserTurn] = {}
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._lock_users: Dict[int, int] = {}
+        self.superseded = 0
+
+    def begin(self, user_id: int, text: Optional[str] = None, supersede: bool = False) -> UserTurn:
+        """
+        Новый ход: text — сообщение пользователя, None — нажатие кнопки.
+
+        Ход с кнопки не вытесняет незавершённый ход с текстом (иначе набранное сообщение
+        пропало бы без ответа): он выполняется сам по себе, не становясь текущим.
+        supersede=True — кнопка из ответа на этот самый текст («Готово», «Сразу дать промпт»
+        под вопросами, которые ещё дописываются): ход с текстом отменяется, его тексты
+        в новый ход не переходят.
+        """
+        previous = self._turns.get(user_id)
+        pending = previous is not None and not previous.finished
+        if text is None and pending and previous.texts and not supersede:
+            return UserTurn([])
+        texts: List[str] = []
+        if pending:
+            self._supersede(previous)
+            if text is not None:
+                texts.extend(previous.texts)
+        if text is not None:
+            texts.append(text)
+        turn = UserTurn(texts)
+        self._turns[user_id] = turn
+        return turn
+
+    async def run(self, user_id: int, turn: UserTurn, request: Callable[[], Awaitable[Any]]) -> Any:
+        if turn.superseded:
+            raise SupersededError()
+
+        async def _run():
+            if self.debounce > 0:
+                await asyncio.sleep(self.debounce)
+            return await request()
+
+        turn.task = asyncio.create_task(_run())
+        try:
+            return await turn.task
+        except asyncio.CancelledError:
+            if turn.superseded:
+                raise SupersededError() from None
+            raise
+        finally:
+            turn.finished = True
+            if self._turns.get(user_id) is turn:
+                del self._turns[user_id]
+
+    def cancel(self, user_id: int):
+        turn = self._turns.pop(user_id, None)
+        if turn is not None and not turn.finished:
+            self._supersede(turn)
+
+    def _supersede(self, turn: UserTurn):
+        turn.superseded = True
+        self.superseded += 1
+        if turn.task is not None and not turn.task.done():
+            turn.task.cancel()
+
+    @asynccontextmanager
+    async def history_lock(self, user_id: int):
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        self._lock_users[user_id] = self._lock_users.get(user_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._lock_users[user_id] -= 1
+            if not self._lock_users[user_id]:
+                del self._lock_users[user_id]
+                del self._locks[user_id]
+
+    def stats(self) -> Dict[str, int]:
+        return {"in_flight": len(self._turns), "superseded": self.superseded}
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import signal
+from typing import Optional, Set
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = "/webhook"
+HEALTH_PATH = "/health"
+# Сколько ждать незавершённые обработчики при остановке: docker stop даёт 10 с до SIGKILL
+WEBHOOK_DRAIN_TIMEOUT = 8.0
+
+
+class _InFlightUpdates:
+    """Outer-middleware обновлений: задачи, которые сейчас их обрабатывают (для остановки без потерь)."""
+
+    def __init__(self):
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def __call__(self, handler, event, data):
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            return await handler(event, data)
+        finally:
+            self.tasks.discard(task)
+
+    async def drain(self, timeout: float):
+        """Ждёт обработчики до timeout, оставшиеся отменяет."""
+        pending = set(self.tasks)
+        if not pending:
+            return
+        logger.info(f"Ожидание обработчиков обновлений: {len(pending)}")
+        _, pending = await asyncio.wait(pending, timeout=timeout)
+        if pending:
+            logger.warning(f"Обработчики не успели завершиться и отменены: {len(pending)}")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+def build_webhook_app(
+    dp: Dispatcher,
+    bot: Bot,
+    path: str = WEBHOOK_PATH,
+    secret_token: Optional[str] = None,
+    drain_timeout: float = WEBHOOK_DRAIN_TIMEOUT,
+) -> web.Application:
+    """
+    aiohttp-приложение, принимающее обновления Telegram POST-запросами на path.
+
+    Каждое обновление обрабатывается отдельной задачей (Telegram сразу получает 200), поэтому
+    запросы идут параллельно. Если задан secret_token, запросы без заголовка
+    X-Telegram-Bot-Api-Secret-Token с этим значением отклоняются. При остановке приложение
+    сначала дожидается начатых обработчиков (до drain_timeout секунд), и только потом
+    закрываются сессия бота и всё, что main закрывает после него (пул БД).
+    """
+    app = web.Application()
+    in_flight = _InFlightUpdates()
+    dp.update.outer_middleware(in_flight)
+
+    async def drain(app: web.Application):
+        await in_flight.drain(drain_timeout)
+
+    # Первым в on_shutdown: к этому моменту новые запросы уже не принимаются
+    app.on_shutdown.append(drain)
+    SimpleRequestHandler(dp, bot, handle_in_background=True, secret_token=secret_token).register(app, path=path)
+    # Проверка живости для балансировщика
+    app.router.add_get(HEALTH_PATH, lambda request: web.Response(text="ok"))
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(
+    dp: Dispatcher,
+    bot: Bot,
+    host: str = WEBHOOK_HOST,
+    port: int = WEBHOOK_PORT,
+    path: str = WEBHOOK_PATH,
+    secret_token: Optional[str] = None,
+    base_url: Optional[str] = None,
+):
+    """
+    Запускает приложение и работает до SIGTERM/SIGINT (или отмены). base_url — внешний адрес
+    (https://bot.example.com): если задан, вебхук регистрируется в Telegram; без него сервер только принимает запросы
+    (локальная проверка или вебхук, уже зарегистрированный другим экземпляром).
+    """
+    app = build_webhook_app(dp, bot, path=path, secret_token=secret_token)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        if base_url:
+            url = base_url.rstrip("/") + path
+            await bot.set_webhook(
+                url,
+                secret_token=secret_token,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+            logger.info(f"Вебхук зарегистрирован: {url}")
+        logger.info(f"Приём обновлений на http://{host}:{port}{path}")
+        await _wait_for_stop_signal()
+        logger.info("Получен сигнал остановки")
+    finally:
+        await runner.cleanup()
+
+
+async def _wait_for_stop_signal():
+    # start_polling ловит сигналы сам; здесь без обработчика SIGTERM (docker stop, systemd)
+    # процесс завершился бы, не выполнив finally в main: не сбросились бы FSM-записи и пул БД
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    signals = (signal.SIGTERM, signal.SIGINT)
+    installed = []
+    for sig in signals:
+        try:
+            loop.add_signal_handler(sig, stop.set)
+            installed.append(sig)
+        except (NotImplementedError, RuntimeError):
+            # Windows или не главный поток: остаётся остановка через KeyboardInterrupt/отмену
+            pass
+    try:
+        await stop.wait()
+    finally:
+        for sig in installed:
+            loop.remove_signal_handler(sig)
@@ -0,0 +1,73 @@
+import random
+
+from bot.handlers.commands import _AgentReplyStreamParser, _parse_agent_questions
+
+QUESTIONS_REPLY = (
+    "Пара уточнений перед промптом.\n"
+    "[QUESTIONS]\n"
+    "1. Для какой модели промпт?\n"
+    "- ChatGPT\n"
+    "- Claude\n"
+    "2. Какой тон?\n"
+    "* Деловой\n"
+    "* Дружелюбный\n"
+    "* Нейтральный\n"
+    "3. Нужны примеры?\n"
+    "[/QUESTIONS]\n"
+)
+INLINE_CLOSE_REPLY = "[QUESTIONS]\n1. Один вопрос\n- Да\n- Нет[/QUESTIONS]"
+TOO_MANY_REPLY = "[QUESTIONS]\n" + "".join(f"{i}. Вопрос {i}\n- а\n- б\n" for i in range(1, 9)) + "[/QUESTIONS]"
+TRUNCATED_REPLY = "[QUESTIONS]\n1. Для какой модели?\n- ChatGPT\n- Claude\n2. Какой то"
+PROMPT_REPLY = "Готово:\n[PROMPT]\nТы — опытный редактор.\n[/PROMPT]\nУдачи!"
+
+
+def _splits(text: str):
+    yield [text]
+    for size in (1, 2, 3, 7, 13):
+        yield [text[i:i + size] for i in range(0, len(text), size)]
+    rng = random.Random(len(text))
+    for _ in range(20):
+        cuts = sorted(rng.sample(range(1, len(text)), min(5, len(text) - 1)))
+        yield [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+
+
+def _stream(chunks: list[str]) -> list[tuple]:
+    parser = _AgentReplyStreamParser()
+    events = []
+    for chunk in chunks:
+        events.extend(parser.feed(chunk))
+    events.extend(parser.close())
+    return events
+
+
+def _questions(events: list[tuple]) -> list[dict]:
+    return [event[2] for event in events if event[0] == "question"]
+
+
+def test_streamed_questions_match_batch_parser():
+    for reply in (QUESTIONS_REPLY, INLINE_CLOSE_REPLY, TOO_MANY_REPLY):
+        expected = _parse_agent_questions(reply)
+        for chunks in _splits(reply):
+            events = _stream(chunks)
+            assert _questions(events) == expected, chunks
+            flags = [event[3] for event in events if event[0] == "question"]
+            assert flags == [False] * (len(expected) - 1) + [True], chunks
+
+
+def test_truncated_questions_drop_the_unclosed_question():
+    assert _parse_agent_questions(TRUNCATED_REPLY) is None
+    for chunks in _splits(TRUNCATED_REPLY):
+        events = _stream(chunks)
+        assert _questions(events) == [{"question": "Для какой модели?", "options": ["ChatGPT", "Claude"]}], chunks
+        assert events[-1] == ("questions_truncated",)
+
+
+def test_prompt_reply_streams_prompt_block():
+    assert _parse_agent_questions(PROMPT_REPLY) is None
+    for chunks in _splits(PROMPT_REPLY):
+        events = _stream(chunks)
+        assert not _questions(events)
+        assert events[0] == ("intro", "Готово:")
+        prompt = "".join(event[1] for event in events if event[0] == "prompt_chunk")
+        assert prompt.strip() == "Ты — опытный редактор."
+        assert events[-1] == ("prompt_done",)
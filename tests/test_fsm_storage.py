@@ -0,0 +1,55 @@
+import asyncio
+
+from aiogram.fsm.storage.base import StorageKey
+
+from bot.db.fsm_storage import SQLiteStorage
+from bot.db.sqlite_manager import SQLiteManager
+
+KEY = StorageKey(bot_id=1, chat_id=10, user_id=10)
+
+
+async def _storage(tmp_path, flush_interval: float) -> SQLiteStorage:
+    db_manager = SQLiteManager(db_path=str(tmp_path / "bot.db"), pool_size=2)
+    await db_manager.init_db()
+    return SQLiteStorage(db_manager, flush_interval=flush_interval)
+
+
+async def _close(storage: SQLiteStorage):
+    await storage.close()
+    await storage.db_manager.close()
+
+
+def test_concurrent_update_data_keeps_all_keys(tmp_path):
+    async def scenario(flush_interval):
+        storage = await _storage(tmp_path / str(flush_interval), flush_interval)
+        try:
+            await asyncio.gather(
+                storage.update_data(KEY, {"agent_questions": [1, 2]}),
+                storage.update_data(KEY, {"agent_answers": {"0": [1]}}),
+                storage.set_state(KEY, "AgentStates:answering_questions"),
+            )
+            assert await storage.get_data(KEY) == {"agent_questions": [1, 2], "agent_answers": {"0": [1]}}
+            assert await storage.get_state(KEY) == "AgentStates:answering_questions"
+        finally:
+            await _close(storage)
+
+    for flush_interval in (0, 1.0):
+        (tmp_path / str(flush_interval)).mkdir()
+        asyncio.run(scenario(flush_interval))
+
+
+def test_state_survives_restart(tmp_path):
+    async def scenario():
+        storage = await _storage(tmp_path, 1.0)
+        await storage.set_state(KEY, "AgentStates:answering_questions")
+        await storage.update_data(KEY, {"agent_answers": {"0": [1]}})
+        await _close(storage)
+
+        storage = await _storage(tmp_path, 1.0)
+        try:
+            assert await storage.get_state(KEY) == "AgentStates:answering_questions"
+            assert await storage.get_data(KEY) == {"agent_answers": {"0": [1]}}
+        finally:
+            await _close(storage)
+
+    asyncio.run(scenario())
@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from bot.services.speculative import SpeculativeReplies
+from bot.services.user_tasks import SupersededError, UserTaskRegistry
+
+REQUEST = {"user_message": "q", "provider": "gemini"}
+
+
+class _FakeLLM:
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.calls = []
+
+    async def chat_with_history(self, **request):
+        self.calls.append(request)
+        await asyncio.sleep(self.delay)
+        return "reply"
+
+
+def test_take_returns_finished_speculation():
+    async def scenario():
+        speculative = SpeculativeReplies(_FakeLLM(0))
+        speculative.start(1, **REQUEST)
+        assert await speculative.take(1, **REQUEST) == "reply"
+        assert speculative.stats() == {"hits": 1, "misses": 0, "pending": 0}
+
+    asyncio.run(scenario())
+
+
+def test_superseded_during_take_propagates_cancellation():
+    async def scenario():
+        llm = _FakeLLM(10)
+        speculative = SpeculativeReplies(llm)
+        user_tasks = UserTaskRegistry()
+        speculative.start(1, **REQUEST)
+        fallback_calls = []
+
+        async def skip_reply():
+            reply = await speculative.take(1, **REQUEST)
+            if reply is not None:
+                return reply
+            fallback_calls.append(True)
+            return "cold"
+
+        turn = user_tasks.begin(1)
+        skip = asyncio.create_task(user_tasks.run(1, turn, skip_reply))
+        await asyncio.sleep(0.01)
+        user_tasks.begin(1, "new message")
+        with pytest.raises(SupersededError):
+            await skip
+        await asyncio.sleep(0)
+        assert not fallback_calls
+        assert len(llm.calls) == 1
+        assert speculative.stats()["pending"] == 0
+        await speculative.close()
+
+    asyncio.run(scenario())
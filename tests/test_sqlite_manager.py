@@ -0,0 +1,17 @@
+import asyncio
+
+import pytest
+
+from bot.db.sqlite_manager import SQLiteManager
+
+
+def test_closed_manager_does_not_reopen_pool(tmp_path):
+    async def scenario():
+        db_manager = SQLiteManager(db_path=str(tmp_path / "bot.db"), pool_size=1)
+        await db_manager.init_db()
+        await db_manager.close()
+        with pytest.raises(RuntimeError):
+            await db_manager.get_user(1)
+        assert db_manager._connections == []
+
+    asyncio.run(scenario())
@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+from bot.services.user_tasks import SupersededError, UserTaskRegistry
+
+
+async def _pending_text_turn(user_tasks: UserTaskRegistry):
+    turn = user_tasks.begin(1, "текст")
+    task = asyncio.create_task(user_tasks.run(1, turn, lambda: asyncio.sleep(10)))
+    await asyncio.sleep(0)
+    return task
+
+
+def test_unrelated_button_leaves_pending_text_turn():
+    async def scenario():
+        user_tasks = UserTaskRegistry()
+        text_task = await _pending_text_turn(user_tasks)
+        button = user_tasks.begin(1)
+        assert button.texts == []
+        assert await user_tasks.run(1, button, lambda: asyncio.sleep(0, "button")) == "button"
+        assert not text_task.done()
+        text_task.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_button_from_the_same_flow_supersedes_text_turn():
+    async def scenario():
+        user_tasks = UserTaskRegistry()
+        text_task = await _pending_text_turn(user_tasks)
+        button = user_tasks.begin(1, supersede=True)
+        assert button.texts == []
+        with pytest.raises(SupersededError):
+            await text_task
+        assert await user_tasks.run(1, button, lambda: asyncio.sleep(0, "button")) == "button"
+
+    asyncio.run(scenario())